@@ -1,12 +1,19 @@
-from flask import Flask, jsonify, request, g
+from flask import Flask, jsonify, request, g, Response
 from flask_cors import CORS
 import os
 from dotenv import load_dotenv
 from auth import auth_routes, token_required
 from models import db, User, Filter, Image, FilteredImage, FilterJob, ProcessingStatus
+import filters
+import encoders
+import metrics
+import storage
+import time
 import uuid
 import json
+from datetime import datetime
 from sqlalchemy.exc import SQLAlchemyError
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
 
 # Load environment variables
 load_dotenv()
@@ -19,12 +26,59 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-key-change-in-production
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = os.getenv('SQLALCHEMY_TRACK_MODIFICATIONS', False)
 
+# Direct uploads: clients PUT originals to presigned storage URLs that
+# expire after UPLOAD_EXPIRES seconds. The upload session travels in a
+# signed token, so nothing is stored until the upload is completed.
+UPLOAD_MAX_MB = float(os.getenv('UPLOAD_MAX_MB', 500))
+UPLOAD_EXPIRES = int(os.getenv('UPLOAD_EXPIRES', 3600))
+UPLOAD_CONTENT_TYPES = {
+    'image/jpeg': 'jpg',
+    'image/png': 'png',
+    'image/webp': 'webp',
+    'image/avif': 'avif',
+    'image/gif': 'gif',
+    'image/tiff': 'tiff',
+}
+upload_tokens = URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='upload-session')
+
 # Initialize database
 db.init_app(app)
 
 # Register authentication routes
 app.register_blueprint(auth_routes)
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' in g:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - g.request_started,
+                        method=request.method, endpoint=endpoint, status=str(response.status_code))
+    metrics.flush()
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics for the API and every worker"""
+    token = os.getenv('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        # Counted from the database, so images of a killed worker drop out
+        # once their lease lapses
+        in_progress = FilteredImage.query.filter(
+            FilteredImage.status == ProcessingStatus.PROCESSING,
+            FilteredImage.lease_expires_at > datetime.utcnow()
+        ).count()
+        return Response(metrics.render({'images_in_progress': in_progress}),
+                        mimetype='text/plain; version=0.0.4')
+    except Exception as e:
+        app.logger.error(f"Failed to render metrics: {str(e)}")
+        return jsonify({"error": "Metrics unavailable"}), 503
+
 @app.route('/')
 def hello():
     return jsonify({"message": "Artyfy API is running"})
@@ -105,6 +159,12 @@ def create_filter():
         if field not in data:
             return jsonify({"error": f"Missing required field: {field}"}), 400
     
+    # Validate filter settings by compiling them
+    try:
+        filters.compile_settings(data['settings'])
+    except ValueError as e:
+        return jsonify({"error": f"Invalid filter settings: {str(e)}"}), 400
+    
     # Create new filter
     try:
         new_filter = Filter(
@@ -198,6 +258,10 @@ def update_filter(filter_id):
         if 'description' in data:
             filter_obj.description = data['description']
         if 'settings' in data:
+            try:
+                filters.compile_settings(data['settings'])
+            except ValueError as e:
+                return jsonify({"error": f"Invalid filter settings: {str(e)}"}), 400
             filter_obj.settings = data['settings']
         if 'is_public' in data:
             filter_obj.is_public = data['is_public']
@@ -206,6 +270,10 @@ def update_filter(filter_id):
         
         db.session.commit()
         
+        # Workers cache filter settings; make them reload these
+        if 'settings' in data:
+            invalidate_filter(filter_obj.id)
+        
         return jsonify({
             "id": str(filter_obj.id),
             "user_id": str(filter_obj.user_id),
@@ -243,6 +311,7 @@ def delete_filter(filter_id):
         
         db.session.delete(filter_obj)
         db.session.commit()
+        invalidate_filter(filter_uuid)
         
         return jsonify({"message": "Filter deleted successfully"})
     except ValueError:
@@ -251,7 +320,26 @@ def delete_filter(filter_id):
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
+def invalidate_filter(filter_id):
+    """Drop a filter from every worker's cache"""
+    try:
+        from tasks import publish_invalidation
+        publish_invalidation('filter', filter_id)
+    except Exception as e:
+        app.logger.error(f"Failed to invalidate cached filter {filter_id}: {str(e)}")
+
 # Image and processing-related routes
+def image_to_dict(img):
+    """Return the JSON representation of an original image"""
+    return {
+        "id": str(img.id),
+        "user_id": str(img.user_id),
+        "original_url": img.original_url,
+        "renditions": img.renditions,
+        "created_at": img.created_at.isoformat(),
+        "updated_at": img.updated_at.isoformat()
+    }
+
 @app.route('/api/images', methods=['POST'])
 @token_required
 def upload_image():
@@ -266,21 +354,29 @@ def upload_image():
     if not data or 'original_url' not in data:
         return jsonify({"error": "Missing required field: original_url"}), 400
     
+    # Workers read the file with the server's credentials, so it must be in our own bucket
+    storage_key = storage.key_for_url(data['original_url'])
+    if storage_key is None:
+        return jsonify({"error": "original_url must be a file in the storage bucket"}), 400
+    
     try:
         new_image = Image(
             user_id=user.id,
-            original_url=data['original_url']
+            original_url=data['original_url'],
+            storage_bucket=storage.bucket_name(),
+            storage_key=storage_key
         )
         db.session.add(new_image)
         db.session.commit()
         
-        return jsonify({
-            "id": str(new_image.id),
-            "user_id": str(new_image.user_id),
-            "original_url": new_image.original_url,
-            "created_at": new_image.created_at.isoformat(),
-            "updated_at": new_image.updated_at.isoformat()
-        }), 201
+        # Previews are made in the background; the image is usable without them
+        try:
+            from tasks import generate_renditions
+            generate_renditions.delay(str(new_image.id))
+        except Exception as e:
+            app.logger.error(f"Failed to queue renditions for image {new_image.id}: {str(e)}")
+        
+        return jsonify(image_to_dict(new_image)), 201
     except SQLAlchemyError as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
@@ -294,18 +390,141 @@ def get_user_images():
         return jsonify({"error": "User not found"}), 404
     
     images = Image.query.filter_by(user_id=user.id).all()
-    result = []
+    return jsonify([image_to_dict(img) for img in images])
+
+@app.route('/api/uploads', methods=['POST'])
+@token_required
+def create_upload():
+    """Start a direct upload of an original to storage"""
+    user = User.query.filter_by(firebase_uid=request.user_id).first()
+    if not user:
+        return jsonify({"error": "User not found"}), 404
     
-    for img in images:
-        result.append({
-            "id": str(img.id),
-            "user_id": str(img.user_id),
-            "original_url": img.original_url,
-            "created_at": img.created_at.isoformat(),
-            "updated_at": img.updated_at.isoformat()
-        })
+    data = request.get_json()
+    if not data or 'content_type' not in data or 'size' not in data:
+        return jsonify({"error": "Missing required fields: content_type, size"}), 400
     
-    return jsonify(result)
+    content_type = data['content_type']
+    if content_type not in UPLOAD_CONTENT_TYPES:
+        return jsonify({"error": f"Unsupported content type: {content_type}"}), 400
+    
+    size = data['size']
+    if isinstance(size, bool) or not isinstance(size, int) or size <= 0:
+        return jsonify({"error": "size must be a positive integer"}), 400
+    if size > UPLOAD_MAX_MB * 1024 * 1024:
+        return jsonify({"error": f"Files over {UPLOAD_MAX_MB:g} MB cannot be uploaded"}), 413
+    
+    if not storage.direct_uploads_supported():
+        return jsonify({"error": "Direct uploads are not supported by this storage backend"}), 501
+    
+    # The server picks the key, so clients can only write where they were told to
+    key = storage.object_key(f"{uuid.uuid4().hex}.{UPLOAD_CONTENT_TYPES[content_type]}")
+    upload = storage.presign_upload(key, content_type, size, UPLOAD_EXPIRES)
+    if upload is None:
+        return jsonify({"error": "Failed to prepare upload"}), 500
+    
+    token = upload_tokens.dumps({
+        "user_id": str(user.id),
+        "key": key,
+        "content_type": content_type,
+        "size": size,
+        "upload_id": upload.get('upload_id')
+    })
+    
+    if 'url' in upload:
+        return jsonify({
+            "upload_token": token,
+            "method": "PUT",
+            "url": upload['url'],
+            "headers": {"Content-Type": content_type},
+            "expires_in": UPLOAD_EXPIRES
+        }), 201
+    return jsonify({
+        "upload_token": token,
+        "method": "PUT",
+        "part_size": upload['part_size'],
+        "parts": upload['parts'],
+        "expires_in": UPLOAD_EXPIRES
+    }), 201
+
+@app.route('/api/uploads/complete', methods=['POST'])
+@token_required
+def complete_upload():
+    """Verify a finished direct upload and register it as an image"""
+    user = User.query.filter_by(firebase_uid=request.user_id).first()
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+    
+    if not storage.direct_uploads_supported():
+        return jsonify({"error": "Direct uploads are not supported by this storage backend"}), 501
+    
+    data = request.get_json()
+    if not data or 'upload_token' not in data:
+        return jsonify({"error": "Missing required field: upload_token"}), 400
+    
+    try:
+        # Allow as long again to complete an upload that finished just as its URLs expired
+        session = upload_tokens.loads(data['upload_token'], max_age=2 * UPLOAD_EXPIRES)
+    except SignatureExpired:
+        return jsonify({"error": "Upload has expired"}), 410
+    except BadSignature:
+        return jsonify({"error": "Invalid upload token"}), 400
+    if session['user_id'] != str(user.id):
+        return jsonify({"error": "Upload not found or not owned by user"}), 404
+    
+    key = session['key']
+    original_url = storage.file_url(key)
+    
+    try:
+        # Completing an upload again returns the image it created the first time
+        new_image = Image.query.filter_by(user_id=user.id, original_url=original_url).first()
+        if new_image:
+            return jsonify(image_to_dict(new_image))
+        
+        # An earlier attempt may have assembled the file and then failed to
+        # save the image; completing it again would fail with NoSuchUpload
+        stored = storage.head_file(key)
+        if session['upload_id'] and not (stored and stored['size'] == session['size']):
+            parts = data.get('parts')
+            if not isinstance(parts, list) or not parts or not all(
+                    isinstance(part, dict) and isinstance(part.get('part_number'), int)
+                    and isinstance(part.get('etag'), str) for part in parts):
+                return jsonify({"error": "parts must list the part_number and etag of every uploaded part"}), 400
+            if not storage.complete_upload(key, session['upload_id'],
+                                           [(part['part_number'], part['etag']) for part in parts]):
+                # Don't leave the uploaded parts behind; the client starts a new upload
+                storage.abort_upload(key, session['upload_id'])
+                return jsonify({"error": "Failed to complete multipart upload"}), 400
+            stored = storage.head_file(key)
+        
+        # Trust what storage holds, not what the client says it sent
+        if stored is None:
+            return jsonify({"error": "File has not been uploaded"}), 400
+        if stored['size'] != session['size']:
+            storage.delete_file(key)
+            return jsonify({"error": f"Uploaded file has {stored['size']} bytes, expected {session['size']}"}), 400
+        
+        new_image = Image(
+            user_id=user.id,
+            original_url=original_url,
+            storage_bucket=storage.bucket_name(),
+            storage_key=key,
+            file_size=stored['size']
+        )
+        db.session.add(new_image)
+        db.session.commit()
+        
+        # Previews are made in the background; the image is usable without them
+        try:
+            from tasks import generate_renditions
+            generate_renditions.delay(str(new_image.id))
+        except Exception as e:
+            app.logger.error(f"Failed to queue renditions for image {new_image.id}: {str(e)}")
+        
+        return jsonify(image_to_dict(new_image)), 201
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
 
 @app.route('/api/process', methods=['POST'])
 @token_required
@@ -320,21 +539,30 @@ def process_images():
         return jsonify({"error": "Invalid request data"}), 400
     
     # Validate required fields
-    required_fields = ['filter_id', 'image_ids']
-    for field in required_fields:
-        if field not in data:
-            return jsonify({"error": f"Missing required field: {field}"}), 400
+    if 'image_ids' not in data:
+        return jsonify({"error": "Missing required field: image_ids"}), 400
+    if 'filter_id' not in data and 'filter_ids' not in data:
+        return jsonify({"error": "Missing required field: filter_id or filter_ids"}), 400
+    
+    # A job applies one filter, or several filters to every image
+    filter_id_values = data['filter_ids'] if 'filter_ids' in data else [data['filter_id']]
+    if not isinstance(filter_id_values, list) or not filter_id_values:
+        return jsonify({"error": "filter_ids must be a non-empty list"}), 400
+    # A job with no images would never finish
+    if not isinstance(data['image_ids'], list) or not data['image_ids']:
+        return jsonify({"error": "image_ids must be a non-empty list"}), 400
     
     try:
-        # Verify filter exists and is accessible to the user
-        filter_uuid = uuid.UUID(data['filter_id'])
-        filter_obj = Filter.query.filter(
-            (Filter.id == filter_uuid) & 
+        # Verify filters exist and are accessible to the user
+        filter_uuids = list(dict.fromkeys(uuid.UUID(fid) for fid in filter_id_values))
+        filter_objs = Filter.query.filter(
+            Filter.id.in_(filter_uuids) & 
             ((Filter.user_id == user.id) | (Filter.is_public == True) | (Filter.is_default == True))
-        ).first()
+        ).all()
         
-        if not filter_obj:
+        if len(filter_objs) != len(filter_uuids):
             return jsonify({"error": "Filter not found or not accessible"}), 404
+        filter_uuid = filter_uuids[0]
         
         # Verify all images exist and belong to the user
         image_ids = [uuid.UUID(img_id) for img_id in data['image_ids']]
@@ -343,38 +571,68 @@ def process_images():
         if len(images) != len(image_ids):
             return jsonify({"error": "Some images not found or not owned by user"}), 404
         
+        # Optional per-job processing options
+        options = {}
+        if data.get('max_dimension') is not None:
+            try:
+                options['max_dimension'] = filters.parse_max_dimension(data['max_dimension'])
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+        if data.get('output') is not None:
+            try:
+                options['output'] = encoders.parse_output_options(data['output'])
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+        
         # Create filter job
         new_job = FilterJob(
             user_id=user.id,
             filter_id=filter_uuid,
             status=ProcessingStatus.PENDING,
-            image_count=len(images),
-            completed_count=0
+            filter_ids=[str(fid) for fid in filter_uuids] if len(filter_uuids) > 1 else None,
+            image_count=len(images) * len(filter_uuids),
+            completed_count=0,
+            failed_count=0,
+            options=options or None
         )
         db.session.add(new_job)
+        # Assign the job ID before referencing it
+        db.session.flush()
         
-        # Create filtered image entries for each image
+        # Create filtered image entries for each image and filter
         for img in images:
-            filtered_img = FilteredImage(
-                image_id=img.id,
-                filter_id=filter_uuid,
-                filter_job_id=new_job.id,
-                status=ProcessingStatus.PENDING
-            )
-            db.session.add(filtered_img)
+            for fid in filter_uuids:
+                filtered_img = FilteredImage(
+                    image_id=img.id,
+                    filter_id=fid,
+                    filter_job_id=new_job.id,
+                    status=ProcessingStatus.PENDING
+                )
+                db.session.add(filtered_img)
         
         db.session.commit()
         
-        # TODO: Queue the job for async processing with Celery
-        # This will be implemented in a separate file
+        # Queue the job for async processing; process_job is routed to the
+        # interactive queue so that bulk jobs reach the scheduler straight away
+        try:
+            from tasks import process_job
+            process_job.delay(str(new_job.id))
+        except Exception as e:
+            app.logger.error(f"Failed to queue job {new_job.id}: {str(e)}")
+            new_job.status = ProcessingStatus.FAILED
+            db.session.commit()
+            return jsonify({"error": "Failed to queue job for processing"}), 503
         
         return jsonify({
             "job_id": str(new_job.id),
             "user_id": str(new_job.user_id),
             "filter_id": str(new_job.filter_id),
+            "filter_ids": new_job.filter_ids or [str(new_job.filter_id)],
             "status": new_job.status.value,
             "image_count": new_job.image_count,
             "completed_count": new_job.completed_count,
+            "failed_count": new_job.failed_count,
+            "options": new_job.options,
             "created_at": new_job.created_at.isoformat(),
             "updated_at": new_job.updated_at.isoformat()
         }), 201
@@ -400,9 +658,12 @@ def get_user_jobs():
             "id": str(job.id),
             "user_id": str(job.user_id),
             "filter_id": str(job.filter_id),
+            "filter_ids": job.filter_ids or [str(job.filter_id)],
             "status": job.status.value,
             "image_count": job.image_count,
             "completed_count": job.completed_count,
+            "failed_count": job.failed_count,
+            "options": job.options,
             "created_at": job.created_at.isoformat(),
             "updated_at": job.updated_at.isoformat()
         })
@@ -432,8 +693,11 @@ def get_job_details(job_id):
             original_image = Image.query.get(img.image_id)
             images_data.append({
                 "id": str(img.id),
+                "filter_id": str(img.filter_id),
                 "original_url": original_image.original_url if original_image else None,
+                "original_renditions": original_image.renditions if original_image else None,
                 "result_url": img.result_url,
+                "renditions": img.renditions,
                 "status": img.status.value
             })
         
@@ -441,9 +705,12 @@ def get_job_details(job_id):
             "id": str(job.id),
             "user_id": str(job.user_id),
             "filter_id": str(job.filter_id),
+            "filter_ids": job.filter_ids or [str(job.filter_id)],
             "status": job.status.value,
             "image_count": job.image_count,
             "completed_count": job.completed_count,
+            "failed_count": job.failed_count,
+            "options": job.options,
             "created_at": job.created_at.isoformat(),
             "updated_at": job.updated_at.isoformat(),
             "images": images_data
@@ -453,6 +720,67 @@ def get_job_details(job_id):
     except SQLAlchemyError as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+@token_required
+def cancel_job(job_id):
+    """Cancel a filter job, dropping every image not processed yet"""
+    user = User.query.filter_by(firebase_uid=request.user_id).first()
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+    
+    try:
+        job_uuid = uuid.UUID(job_id)
+        job = FilterJob.query.filter_by(id=job_uuid, user_id=user.id).first()
+        
+        if not job:
+            return jsonify({"error": "Job not found or not owned by user"}), 404
+        
+        # Conditional, as workers may be finishing the job at the same moment
+        cancelled = FilterJob.query.filter(
+            FilterJob.id == job.id,
+            FilterJob.status.in_([ProcessingStatus.PENDING, ProcessingStatus.PROCESSING])
+        ).update({FilterJob.status: ProcessingStatus.CANCELLED}, synchronize_session=False)
+        if not cancelled:
+            db.session.rollback()
+            return jsonify({"error": "Job has already finished"}), 409
+        
+        # Queued images are dropped here; workers drop images in progress
+        # at their next stage once they see the cancellation flag
+        FilteredImage.query.filter(
+            FilteredImage.filter_job_id == job.id,
+            FilteredImage.status == ProcessingStatus.PENDING
+        ).update({FilteredImage.status: ProcessingStatus.CANCELLED}, synchronize_session=False)
+        db.session.commit()
+        
+        from tasks import flag_job_cancelled, schedule_bulk_work
+        if not flag_job_cancelled(job.id):
+            app.logger.warning(f"Job {job.id} cancelled, but workers were not notified")
+        # The job's bulk slots are free for other users' work
+        try:
+            schedule_bulk_work.delay()
+        except Exception as e:
+            app.logger.warning(f"Failed to queue the bulk scheduler: {str(e)}")
+        
+        db.session.refresh(job)
+        return jsonify({
+            "id": str(job.id),
+            "user_id": str(job.user_id),
+            "filter_id": str(job.filter_id),
+            "filter_ids": job.filter_ids or [str(job.filter_id)],
+            "status": job.status.value,
+            "image_count": job.image_count,
+            "completed_count": job.completed_count,
+            "failed_count": job.failed_count,
+            "options": job.options,
+            "created_at": job.created_at.isoformat(),
+            "updated_at": job.updated_at.isoformat()
+        })
+    except ValueError:
+        return jsonify({"error": "Invalid job ID format"}), 400
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
 # Application initialization
 with app.app_context():
     # Create all tables in the database if they don't exist yet
@@ -0,0 +1,249 @@
+"""
+Benchmark the image filter engine
+
+Runs every filter type against synthetic images in several modes and sizes,
+the same way the workers do (a decoded image is filtered and encoded by
+filters.render), and reports throughput in megapixels per second and peak
+memory. Each case runs in its own subprocess so that its peak RSS is not
+hidden by an earlier, larger case.
+
+Results are compared against benchmarks/baseline.json and the script exits
+with status 1 when a case is slower than its baseline by more than the
+tolerance. Baselines are machine specific: record one with --update-baseline
+on the machine you compare on.
+
+Usage:
+    python benchmarks/bench_filters.py
+    python benchmarks/bench_filters.py --sizes small --filters blur,vintage
+    python benchmarks/bench_filters.py --update-baseline
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Benchmarks measure the engine alone, without pushing metrics to Redis
+os.environ.setdefault('METRICS_ENABLED', 'false')
+
+from PIL import Image as PILImage  # noqa: E402
+
+import filters  # noqa: E402
+
+BASELINE_PATH = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+# Filter settings by case name, one per filter type. ``add_vignette`` calls
+# filters.add_vignette directly rather than going through render.
+FILTERS = {
+    'grayscale': {'type': 'grayscale'},
+    'sepia': {'type': 'sepia'},
+    'vintage': {'type': 'vintage'},
+    'desaturate': {'steps': [{'type': 'desaturate'}]},
+    'tone': {'steps': [{'type': 'tone'}]},
+    'brightness': {'steps': [{'type': 'brightness'}]},
+    'contrast': {'steps': [{'type': 'contrast'}]},
+    'blur': {'steps': [{'type': 'blur', 'radius': 2}]},
+    'sharpen': {'steps': [{'type': 'sharpen'}]},
+    'vignette': {'steps': [{'type': 'vignette'}]},
+    'add_vignette': None,
+}
+
+MODES = ('RGB', 'RGBA', 'L', 'P')
+
+SIZES = {
+    'small': (800, 600),
+    'medium': (2048, 1536),
+    'large': (4000, 3000),
+}
+
+
+def synthetic_image(mode, size):
+    """Build a deterministic test image with gradients and fine detail"""
+    gradient = PILImage.linear_gradient('L').resize(size)
+    noise = PILImage.effect_noise(size, 48)
+    rgb = PILImage.merge('RGB', (gradient, noise, gradient.rotate(180)))
+    if mode == 'RGBA':
+        rgb.putalpha(PILImage.radial_gradient('L').resize(size))
+        return rgb
+    if mode == 'P':
+        return rgb.quantize(256)
+    return rgb.convert(mode)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process, in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def current_rss_mb():
+    """Current resident set size, where the platform exposes it cheaply"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except OSError:
+        # Without /proc, fall back to the high-water mark so far
+        return peak_rss_mb()
+
+
+def run_case(filter_name, path, repeat, min_time):
+    """Time one filter on one input image; runs inside the case subprocess"""
+    img = PILImage.open(path)
+    img.load()
+    megapixels = img.width * img.height / 1e6
+    settings = FILTERS[filter_name]
+
+    # render may filter its input in place, so every call gets a fresh copy,
+    # made outside the timed region
+    if settings is None:
+        def run(source):
+            filters.add_vignette(source)
+    else:
+        def run(source):
+            filters.render(source, settings)
+
+    source = img.copy()
+    rss_before = current_rss_mb()
+    # The first run compiles the plan and fills the mask cache, as on a warm worker
+    run(source)
+    timings = []
+    for _ in range(repeat):
+        # Fast cases are repeated until a sample spans min_time, so timer and
+        # scheduler noise do not dominate small images
+        elapsed, calls = 0.0, 0
+        while calls == 0 or elapsed < min_time:
+            source = img.copy()
+            start = time.perf_counter()
+            run(source)
+            elapsed += time.perf_counter() - start
+            calls += 1
+        timings.append(elapsed / calls)
+
+    timings.sort()
+    return {
+        'mp_per_s': round(megapixels / timings[len(timings) // 2], 2),
+        'peak_mb': round(max(peak_rss_mb() - rss_before, 0), 1),
+    }
+
+
+def spawn_case(filter_name, path, repeat, min_time):
+    """Run a case in a fresh interpreter and return its result"""
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--run-case', filter_name, path, str(repeat),
+         str(min_time)],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output)
+
+
+def load_baseline():
+    if not os.path.exists(BASELINE_PATH):
+        return {'cases': {}}
+    with open(BASELINE_PATH) as f:
+        return json.load(f)
+
+
+def save_baseline(baseline, results):
+    baseline['cases'].update(results)
+    baseline['cases'] = dict(sorted(baseline['cases'].items()))
+    baseline['environment'] = environment()
+    with open(BASELINE_PATH, 'w') as f:
+        json.dump(baseline, f, indent=2)
+        f.write('\n')
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'pillow': PILImage.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor() or None,
+    }
+
+
+def parse_list(value, choices, name):
+    items = [item.strip() for item in value.split(',') if item.strip()]
+    unknown = [item for item in items if item not in choices]
+    if unknown:
+        raise SystemExit(f"Unknown {name}: {', '.join(unknown)} (choose from {', '.join(choices)})")
+    return items
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the image filter engine")
+    parser.add_argument('--filters', default=','.join(FILTERS), help="comma-separated filter cases")
+    parser.add_argument('--modes', default=','.join(MODES), help="comma-separated image modes")
+    parser.add_argument('--sizes', default=','.join(SIZES), help="comma-separated sizes")
+    parser.add_argument('--repeat', type=int, default=5, help="timed samples per case (median is reported)")
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help="minimum seconds per sample; fast cases repeat the filter to fill it")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed throughput drop against the baseline, as a fraction")
+    parser.add_argument('--update-baseline', action='store_true',
+                        help="store these results as the new baseline")
+    parser.add_argument('--run-case', nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        filter_name, path, repeat, min_time = args.run_case
+        print(json.dumps(run_case(filter_name, path, int(repeat), float(min_time))))
+        return 0
+
+    filter_names = parse_list(args.filters, FILTERS, 'filters')
+    modes = parse_list(args.modes, MODES, 'modes')
+    sizes = parse_list(args.sizes, SIZES, 'sizes')
+
+    baseline = load_baseline()
+    if baseline.get('environment', {}).get('pillow') not in (None, PILImage.__version__):
+        print(f"Note: baseline was recorded with Pillow {baseline['environment']['pillow']}, "
+              f"running {PILImage.__version__}")
+
+    results = {}
+    regressions = []
+    print(f"{'case':<32} {'MP/s':>8} {'baseline':>9} {'change':>8} {'peak MB':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size_name in sizes:
+            for mode in modes:
+                # Inputs are stored losslessly so each case decodes exactly this image
+                path = os.path.join(tmp, f"{mode}_{size_name}.png")
+                synthetic_image(mode, SIZES[size_name]).save(path, compress_level=1)
+
+                for filter_name in filter_names:
+                    case = f"{filter_name}/{mode}/{size_name}"
+                    result = spawn_case(filter_name, path, args.repeat, args.min_time)
+                    results[case] = result
+
+                    expected = baseline['cases'].get(case, {}).get('mp_per_s')
+                    if expected:
+                        change = result['mp_per_s'] / expected - 1
+                        compared = f"{expected:>9.2f} {change:>+7.0%}"
+                        if change < -args.tolerance:
+                            regressions.append(case)
+                            compared += ' REGRESSED'
+                    else:
+                        compared = f"{'-':>9} {'-':>8}"
+                    print(f"{case:<32} {result['mp_per_s']:>8.2f} {compared} {result['peak_mb']:>8.1f}")
+
+    if args.update_baseline:
+        save_baseline(baseline, results)
+        print(f"Baseline updated: {os.path.relpath(BASELINE_PATH)}")
+        return 0
+
+    if regressions:
+        print(f"\n{len(regressions)} case(s) slower than baseline by more than {args.tolerance:.0%}:")
+        for case in regressions:
+            print(f"  {case}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+import io
+from collections import namedtuple
+
+from PIL import Image as PILImage
+
+# AVIF support comes from an optional Pillow plugin
+try:
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+# Output formats by name: Pillow format, MIME type, file extension and
+# whether the format can store an alpha channel
+OUTPUT_FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg', False),
+    'png': ('PNG', 'image/png', 'png', True),
+    'webp': ('WEBP', 'image/webp', 'webp', True),
+    'avif': ('AVIF', 'image/avif', 'avif', True),
+}
+
+DEFAULT_FORMAT = 'jpeg'
+
+JPEG_SUBSAMPLING = ('4:4:4', '4:2:2', '4:2:0')
+
+OUTPUT_OPTIONS = ('format', 'quality', 'progressive', 'optimize', 'subsampling', 'lossless')
+
+# ``renditions`` optionally maps rendition sizes to further EncodedImages
+EncodedImage = namedtuple('EncodedImage', ['data', 'content_type', 'extension', 'renditions'],
+                          defaults=(None,))
+
+
+def parse_output_options(options):
+    """
+    Validate output encoding options
+
+    Args:
+        options (dict): Any of ``format`` (jpeg, png, webp or avif), ``quality``
+            (1-100), ``progressive``, ``optimize``, ``subsampling`` (JPEG only,
+            e.g. "4:2:0") and ``lossless`` (WebP only)
+
+    Returns:
+        dict: The validated options, with ``format`` lower-cased
+
+    Raises:
+        ValueError: If an option is unknown or invalid
+    """
+    if options is None:
+        return {}
+    if not isinstance(options, dict):
+        raise ValueError("output must be an object")
+
+    unknown = set(options) - set(OUTPUT_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown output options: {', '.join(sorted(unknown))}")
+
+    parsed = dict(options)
+    if 'format' in parsed:
+        fmt = str(parsed['format']).lower()
+        if fmt == 'jpg':
+            fmt = 'jpeg'
+        if fmt not in OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported output format: {parsed['format']}")
+        # Make sure every installed format plugin is registered
+        PILImage.init()
+        if OUTPUT_FORMATS[fmt][0] not in PILImage.SAVE:
+            raise ValueError(f"{fmt} output is not available on this server")
+        parsed['format'] = fmt
+
+    quality = parsed.get('quality')
+    if quality is not None and (isinstance(quality, bool) or not isinstance(quality, int)
+                                or not 1 <= quality <= 100):
+        raise ValueError("quality must be an integer from 1 to 100")
+
+    for flag in ('progressive', 'optimize', 'lossless'):
+        if flag in parsed and not isinstance(parsed[flag], bool):
+            raise ValueError(f"{flag} must be true or false")
+
+    if 'subsampling' in parsed and parsed['subsampling'] not in JPEG_SUBSAMPLING:
+        raise ValueError(f"subsampling must be one of {', '.join(JPEG_SUBSAMPLING)}")
+
+    return parsed
+
+
+def resolve_output_options(filter_settings, job_options=None):
+    """Merge a filter's output options with a job's, the job's taking precedence"""
+    merged = {}
+    for source in (filter_settings, job_options):
+        if isinstance(source, dict) and source.get('output'):
+            merged.update(parse_output_options(source['output']))
+    return merged
+
+
+def supports_alpha(options):
+    """Return True if the chosen output format keeps transparency"""
+    return OUTPUT_FORMATS[options.get('format', DEFAULT_FORMAT)][3]
+
+
+def encode(img, options=None):
+    """
+    Encode an image with the given output options
+
+    Images with transparency are saved with their alpha channel when the
+    format supports it, and flattened onto white otherwise.
+
+    Args:
+        img (PIL.Image.Image): Image to encode
+        options (dict, optional): Options accepted by parse_output_options
+
+    Returns:
+        EncodedImage: Encoded bytes with their MIME type and file extension
+    """
+    options = options or {}
+    fmt = options.get('format', DEFAULT_FORMAT)
+    pil_format, content_type, extension, alpha = OUTPUT_FORMATS[fmt]
+
+    if 'A' in img.getbands() and not alpha:
+        background = PILImage.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        img = background
+
+    params = {}
+    if 'quality' in options:
+        params['quality'] = options['quality']
+    if options.get('optimize'):
+        params['optimize'] = True
+    if fmt == 'jpeg':
+        if options.get('progressive'):
+            params['progressive'] = True
+        if 'subsampling' in options:
+            params['subsampling'] = options['subsampling']
+    if fmt == 'webp' and options.get('lossless'):
+        params['lossless'] = True
+
+    buffer = io.BytesIO()
+    img.save(buffer, format=pil_format, **params)
+    return EncodedImage(buffer.getvalue(), content_type, extension)
@@ -0,0 +1,878 @@
+import os
+import io
+import json
+import math
+import hashlib
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+from threading import Lock
+
+from PIL import Image as PILImage
+from PIL import ImageFilter
+
+import encoders
+import metrics
+
+# Luma weights used by Pillow's RGB -> L conversion
+LUMA_WEIGHTS = (0.299, 0.587, 0.114)
+
+# Sepia colour matrix (rows are the R, G and B outputs, the fourth column is
+# the offset). Applied with truncation, it reproduces the per-pixel formula
+# ``int(min(255, r * 0.393 + g * 0.769 + b * 0.189))`` to within +/-1 per
+# channel (float32 accumulation in Pillow accounts for the rare off-by-one).
+SEPIA_MATRIX = (
+    0.393, 0.769, 0.189, 0.0,
+    0.349, 0.686, 0.168, 0.0,
+    0.272, 0.534, 0.131, 0.0,
+)
+
+# Per-channel scale factors for the vintage tone step (R, G, B)
+VINTAGE_TONE = (0.9, 0.9, 0.7)
+
+# Number of vignette masks kept per worker process. A 12 MP mask is ~12 MB.
+VIGNETTE_MASK_CACHE_SIZE = int(os.getenv('VIGNETTE_MASK_CACHE_SIZE', 8))
+
+# Images with at least this many pixels are filtered in horizontal strips
+TILED_MIN_PIXELS = int(os.getenv('TILED_MIN_PIXELS', 24_000_000))
+
+# Rows per strip in tiled mode
+TILE_STRIP_HEIGHT = int(os.getenv('TILE_STRIP_HEIGHT', 256))
+
+# Originals with more pixels than this are rejected before decoding. Pillow's
+# own decompression bomb check is aligned with it as a backstop.
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', 100_000_000))
+PILImage.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# Longest side, in pixels, of the preview renditions made for every image
+RENDITION_SIZES = tuple(
+    int(size) for size in os.getenv('RENDITION_SIZES', '128,512,1080').split(',') if size.strip()
+)
+
+# Encoding used for renditions
+RENDITION_OUTPUT = {
+    'format': os.getenv('RENDITION_FORMAT', 'jpeg'),
+    'quality': int(os.getenv('RENDITION_QUALITY', 80)),
+}
+
+# Number of compiled filter plans kept per process
+PLAN_CACHE_SIZE = int(os.getenv('FILTER_PLAN_CACHE_SIZE', 256))
+
+# Pillow's 256x256 radial gradient grows linearly from 0 at the centre; this is
+# its value at the midpoint of an edge, i.e. at a distance of 128 pixels.
+_GRADIENT = PILImage.radial_gradient('L')
+_GRADIENT_EDGE = _GRADIENT.getpixel((0, 128))
+
+
+class LinearStep:
+    """
+    Pointwise step that maps each RGB pixel through a 3x4 colour matrix
+
+    Diagonal matrices (per-channel scaling) run as an exact lookup table;
+    anything else runs as a single Pillow matrix conversion.
+    """
+
+    def __init__(self, name, matrix, truncate=True):
+        self.name = name
+        self.matrix = tuple(float(v) for v in matrix)
+        # Truncate (int()) like the Python reference filters, or round like
+        # Pillow's own RGB -> L conversion
+        self.truncate = truncate
+
+    @property
+    def is_diagonal(self):
+        m = self.matrix
+        return all(m[row * 4 + col] == 0 for row in range(3) for col in range(4) if row != col)
+
+    @property
+    def is_non_expanding(self):
+        """True when every output stays within 0-255, so nothing is clipped"""
+        for row in range(3):
+            coefficients = self.matrix[row * 4:row * 4 + 3]
+            offset = self.matrix[row * 4 + 3]
+            if any(c < 0 for c in coefficients) or offset != 0 or sum(coefficients) > 1:
+                return False
+        return True
+
+    @property
+    def lut(self):
+        lut = []
+        for channel in range(3):
+            factor = self.matrix[channel * 5]
+            offset = self.matrix[channel * 4 + 3]
+            lut.extend(_clip(int(value * factor + offset)) for value in range(256))
+        return lut
+
+    def then(self, other):
+        """Return the step equivalent to applying ``self`` followed by ``other``"""
+        a, b = self.matrix, other.matrix
+        fused = []
+        for row in range(3):
+            for col in range(4):
+                value = sum(b[row * 4 + k] * a[k * 4 + col] for k in range(3))
+                if col == 3:
+                    value += b[row * 4 + 3]
+                fused.append(value)
+        return LinearStep(f"{self.name}+{other.name}", fused, other.truncate)
+
+    def apply(self, img):
+        if self.is_diagonal:
+            return img.point(self.lut)
+        # Pillow rounds matrix conversions; shift by half a level to truncate
+        shift = -0.5 if self.truncate else 0.0
+        matrix = tuple(v + shift if i % 4 == 3 else v for i, v in enumerate(self.matrix))
+        return img.convert('RGB', matrix)
+
+
+class LutStep:
+    """Pointwise step that maps each channel through a 768-entry lookup table"""
+
+    def __init__(self, name, lut):
+        self.name = name
+        self.lut = lut
+
+    def then(self, other):
+        lut = other.lut
+        composed = [lut[channel * 256 + self.lut[channel * 256 + value]]
+                    for channel in range(3) for value in range(256)]
+        return LutStep(f"{self.name}+{other.name}", composed)
+
+    def apply(self, img):
+        return img.point(self.lut)
+
+
+class ContrastStep:
+    """Contrast around the mean luma, equivalent to ImageEnhance.Contrast"""
+
+    name = 'contrast'
+
+    def __init__(self, value):
+        self.value = float(value)
+
+    def lut_for(self, histogram):
+        """Build the lookup table for an image with the given L histogram"""
+        total = sum(histogram) or 1
+        mean = int(sum(i * count for i, count in enumerate(histogram)) / total + 0.5)
+        lut = [_clip(int(mean + self.value * (value - mean))) for value in range(256)]
+        return lut * 3
+
+    def apply(self, img):
+        return img.point(self.lut_for(img.convert('L').histogram()))
+
+
+class ImageStep:
+    """
+    Step that reads a neighbourhood of each pixel (blur, sharpen)
+
+    ``halo`` is how many rows above and below a pixel can influence it; tiled
+    execution overlaps strips by that much so the result is unchanged.
+    """
+
+    def __init__(self, name, func, halo=0):
+        self.name = name
+        self.func = func
+        self.halo = halo
+
+    def apply(self, img):
+        return self.func(img)
+
+
+class VignetteStep:
+    """Radial vignette; pointwise, but depends on each pixel's position"""
+
+    name = 'vignette'
+
+    def __init__(self, level):
+        self.level = level
+
+    def apply(self, img):
+        return _apply_vignette(img, self.level)
+
+    def apply_region(self, img, box, size):
+        """Apply to ``img``, which is the ``box`` region of an image of ``size``"""
+        mask = vignette_mask(size[0], size[1], self.level, box)
+        img.paste((0, 0, 0), None, mask)
+        return img
+
+
+def _clip(value):
+    return 0 if value < 0 else 255 if value > 255 else value
+
+
+def _scale_step(name, factors):
+    r, g, b = factors
+    return LinearStep(name, (r, 0, 0, 0, 0, g, 0, 0, 0, 0, b, 0))
+
+
+def _desaturate_matrix(factor):
+    matrix = []
+    for row in range(3):
+        for col in range(3):
+            value = (1 - factor) * LUMA_WEIGHTS[col]
+            if row == col:
+                value += factor
+            matrix.append(value)
+        matrix.append(0.0)
+    return matrix
+
+
+def _grayscale(params):
+    return [LinearStep('grayscale', LUMA_WEIGHTS + (0.0,) + LUMA_WEIGHTS + (0.0,) + LUMA_WEIGHTS + (0.0,),
+                       truncate=False)]
+
+
+def _sepia(params):
+    return [LinearStep('sepia', SEPIA_MATRIX)]
+
+
+def _desaturate(params):
+    return [LinearStep('desaturate', _desaturate_matrix(float(params.get('value', 0.8))))]
+
+
+def _tone(params):
+    factors = params.get('value', VINTAGE_TONE)
+    if len(factors) != 3:
+        raise ValueError("tone value must be a list of three channel factors")
+    return [_scale_step('tone', [float(f) for f in factors])]
+
+
+def _brightness(params):
+    value = float(params.get('value', 1.2))
+    return [_scale_step('brightness', (value, value, value))]
+
+
+def _contrast(params):
+    return [ContrastStep(params.get('value', 1.5))]
+
+
+def _blur(params):
+    radius = float(params.get('radius', 2))
+    # Pillow approximates the Gaussian with three box blurs, each reaching
+    # roughly one radius plus a pixel
+    halo = math.ceil(3 * radius) + 3
+    return [ImageStep('blur', lambda img: img.filter(ImageFilter.GaussianBlur(radius=radius)), halo)]
+
+
+def _sharpen(params):
+    return [ImageStep('sharpen', lambda img: img.filter(ImageFilter.SHARPEN), halo=1)]
+
+
+def _vignette(params):
+    return [VignetteStep(float(params.get('level', 0.3)))]
+
+
+def _vintage(params):
+    return _desaturate({'value': 0.8}) + _tone({'value': VINTAGE_TONE}) + _vignette({'level': 0.3})
+
+
+# Step builders by "type". Each returns the list of steps it expands to.
+STEP_TYPES = {
+    'grayscale': _grayscale,
+    'sepia': _sepia,
+    'desaturate': _desaturate,
+    'tone': _tone,
+    'brightness': _brightness,
+    'contrast': _contrast,
+    'blur': _blur,
+    'sharpen': _sharpen,
+    'vignette': _vignette,
+    'vintage': _vintage,
+}
+
+
+# Bump when a change to the engine alters output, so cached results are not reused
+ENGINE_VERSION = 1
+
+
+def canonical_settings(settings):
+    """Serialize filter settings to a canonical JSON string"""
+    return json.dumps(settings, sort_keys=True, separators=(',', ':'))
+
+
+def settings_hash(settings):
+    """Return a stable SHA-256 hex digest of filter settings"""
+    return hashlib.sha256(canonical_settings(settings).encode('utf-8')).hexdigest()
+
+
+def result_cache_key(content_hash, filter_settings, max_dimension=None, output_options=None):
+    """
+    Return the key identifying a rendered result
+
+    Two renders with the same key produce the same bytes: same original
+    content, same canonical settings, same size limit and output encoding.
+    """
+    parts = [
+        str(ENGINE_VERSION),
+        content_hash,
+        settings_hash(filter_settings),
+        str(max_dimension or ''),
+        canonical_settings(output_options or {}),
+    ]
+    return hashlib.sha256(':'.join(parts).encode('utf-8')).hexdigest()
+
+
+def _step_list(settings):
+    """Return the ordered list of step dicts described by filter settings"""
+    if isinstance(settings, list):
+        return settings
+    if not isinstance(settings, dict):
+        raise ValueError("Filter settings must be an object or a list of steps")
+    if 'steps' in settings:
+        if not isinstance(settings['steps'], list):
+            raise ValueError("steps must be a list")
+        return settings['steps']
+    # Legacy single-filter settings. Unknown types leave the image unchanged.
+    if settings.get('type') in STEP_TYPES:
+        return [settings]
+    return []
+
+
+def _fuse(steps):
+    """Merge adjacent pointwise steps so each run costs a single pass"""
+    fused = []
+    for step in steps:
+        prev = fused[-1] if fused else None
+        if isinstance(step, LinearStep) and step.is_diagonal and (
+                isinstance(prev, LutStep) or (isinstance(prev, LinearStep) and prev.is_diagonal)):
+            # Chained per-channel tables compose exactly
+            prev_lut = prev if isinstance(prev, LutStep) else LutStep(prev.name, prev.lut)
+            fused[-1] = prev_lut.then(LutStep(step.name, step.lut))
+        elif isinstance(step, LinearStep) and isinstance(prev, LinearStep) and prev.is_non_expanding:
+            # Nothing is clipped between the two, so the matrices multiply;
+            # skipping the truncation between them moves results by up to 2 levels
+            fused[-1] = prev.then(step)
+        else:
+            fused.append(step)
+    return tuple(fused)
+
+
+def compile_steps(steps):
+    """
+    Compile a list of step dicts into an execution plan
+
+    Args:
+        steps (list): Step dicts such as ``{"type": "contrast", "value": 1.5}``
+
+    Returns:
+        tuple: Steps to run in order, with compatible pointwise steps fused
+
+    Raises:
+        ValueError: If a step is malformed or has an unknown type
+    """
+    expanded = []
+    for step in steps:
+        if not isinstance(step, dict) or 'type' not in step:
+            raise ValueError("Each step must be an object with a type")
+        builder = STEP_TYPES.get(step['type'])
+        if builder is None:
+            raise ValueError(f"Unknown filter step type: {step['type']}")
+        try:
+            expanded.extend(builder(step))
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Invalid {step['type']} step: {str(e)}")
+    return _fuse(expanded)
+
+
+_plan_cache = OrderedDict()
+_plan_cache_lock = Lock()
+
+
+def compile_settings(settings):
+    """
+    Return the compiled plan for filter settings, using a per-process cache
+
+    Settings may be a legacy single filter (``{"type": "sepia"}``), an object
+    with an ordered ``steps`` list, or a bare list of steps. Plans are cached
+    by the hash of the canonical settings JSON.
+
+    Raises:
+        ValueError: If the settings are invalid
+    """
+    key = settings_hash(settings)
+    with _plan_cache_lock:
+        plan = _plan_cache.get(key)
+        if plan is not None:
+            _plan_cache.move_to_end(key)
+            return plan
+
+    plan = compile_steps(_step_list(settings))
+    if isinstance(settings, dict):
+        parse_max_dimension(settings.get('max_dimension'))
+        encoders.parse_output_options(settings.get('output'))
+
+    with _plan_cache_lock:
+        _plan_cache[key] = plan
+        if len(_plan_cache) > PLAN_CACHE_SIZE:
+            _plan_cache.popitem(last=False)
+    return plan
+
+
+def parse_max_dimension(value):
+    """
+    Validate a ``max_dimension`` option
+
+    Returns:
+        int: The maximum output width/height in pixels, or None if unset
+
+    Raises:
+        ValueError: If the value is not a positive integer
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+        raise ValueError("max_dimension must be a positive integer")
+    return value
+
+
+def resolve_max_dimension(filter_settings, job_options=None):
+    """Return the effective max_dimension; a job option overrides the filter's"""
+    for source in (job_options, filter_settings):
+        if isinstance(source, dict) and source.get('max_dimension') is not None:
+            return parse_max_dimension(source['max_dimension'])
+    return None
+
+
+def _fit_size(size, max_dimension):
+    """Scale (width, height) down so neither side exceeds max_dimension"""
+    width, height = size
+    scale = max_dimension / max(width, height)
+    if scale >= 1:
+        return size
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def filter_type(settings):
+    """
+    Name filter settings for metrics: the step type of a single-step filter
+    (legacy or not), or "pipeline" for anything longer
+    """
+    try:
+        steps = _step_list(settings)
+    except ValueError:
+        return 'invalid'
+    if len(steps) == 1 and isinstance(steps[0], dict) and steps[0].get('type') in STEP_TYPES:
+        return steps[0]['type']
+    return 'pipeline' if steps else 'none'
+
+
+class ImageTooLarge(ValueError):
+    """Raised for originals with more than MAX_IMAGE_PIXELS pixels"""
+
+
+# What an image's header says about it, read without decoding any pixels
+ImageInfo = namedtuple('ImageInfo', ['width', 'height', 'mode', 'format'])
+
+
+def _stream(image_data):
+    """Wrap encoded bytes for Pillow, or rewind a file that is already open"""
+    if hasattr(image_data, 'read'):
+        image_data.seek(0)
+        return image_data
+    return io.BytesIO(image_data)
+
+
+def _open(image_data):
+    """Open encoded bytes or a seekable file lazily, refusing images over MAX_IMAGE_PIXELS"""
+    try:
+        img = PILImage.open(_stream(image_data))
+    except PILImage.DecompressionBombError as e:
+        raise ImageTooLarge(str(e))
+    if img.width * img.height > MAX_IMAGE_PIXELS:
+        raise ImageTooLarge(f"Image has {img.width}x{img.height} pixels, more than {MAX_IMAGE_PIXELS}")
+    return img
+
+
+def inspect_image(image_data):
+    """
+    Read an image's dimensions, mode and format from its header
+
+    Unlike decode_image, this reports images over MAX_IMAGE_PIXELS rather
+    than refusing them, up to twice that size where Pillow itself gives up.
+
+    Returns:
+        ImageInfo: The header fields
+
+    Raises:
+        ImageTooLarge: If the image is too large for Pillow to open
+        PIL.UnidentifiedImageError: If the bytes are not a supported image
+    """
+    try:
+        img = PILImage.open(_stream(image_data))
+    except PILImage.DecompressionBombError as e:
+        raise ImageTooLarge(str(e))
+    return ImageInfo(img.width, img.height, img.mode, img.format)
+
+
+def decoded_size(info):
+    """Bytes needed to hold an image fully decoded; Pillow stores multi-band pixels in 4 bytes"""
+    return info.width * info.height * (1 if info.mode in ('1', 'L', 'P') else 4)
+
+
+def decode_image(image_data, max_dimension=None):
+    """
+    Decode image bytes, optionally at reduced scale
+
+    With ``max_dimension`` set, JPEGs are decoded in draft mode at the smallest
+    DCT scale (1/2, 1/4 or 1/8) that still covers the target size, other
+    formats are shrunk with Image.reduce, and the result is resampled to fit
+    within ``max_dimension`` x ``max_dimension``.
+
+    Args:
+        image_data (bytes or file): Encoded image, or a seekable file holding
+            one; pixels are read from the file as they are decoded
+        max_dimension (int, optional): Maximum output width/height in pixels
+
+    Returns:
+        PIL.Image.Image: Decoded (loaded) image
+
+    Raises:
+        ImageTooLarge: If the image has more than MAX_IMAGE_PIXELS pixels
+    """
+    with metrics.timer('stage_duration_seconds', stage='decode'):
+        img = _open(image_data)
+        target = _fit_size(img.size, max_dimension) if max_dimension else img.size
+        if target == img.size:
+            img.load()
+            return img
+
+        # No-op for formats other than JPEG
+        img.draft(None, target)
+
+        # Box-reduce while keeping at least twice the target size, like
+        # Image.thumbnail's reducing_gap, so the final resample stays sharp
+        factor = min(img.width // (2 * target[0]), img.height // (2 * target[1]))
+        if factor >= 2:
+            img = img.reduce(factor)
+
+        return img.resize(target, PILImage.LANCZOS)
+
+
+def fit_image(img, max_dimension):
+    """Resample an already decoded image to fit within max_dimension, if needed"""
+    if not max_dimension:
+        return img
+    target = _fit_size(img.size, max_dimension)
+    if target == img.size:
+        return img
+    return img.resize(target, PILImage.LANCZOS, reducing_gap=2.0)
+
+
+def run_plan(plan, img):
+    """
+    Run a compiled plan over an image
+
+    Args:
+        plan (tuple): Plan returned by compile_settings
+        img (PIL.Image.Image): Image in any mode
+
+    Returns:
+        PIL.Image.Image: Filtered RGB image
+    """
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    for step in plan:
+        img = step.apply(img)
+    return img
+
+
+def _l_histogram(img, strip_height):
+    """Luma histogram of an RGB image, computed a strip at a time"""
+    histogram = [0] * 256
+    for top in range(0, img.height, strip_height):
+        strip = img.crop((0, top, img.width, min(img.height, top + strip_height)))
+        for value, count in enumerate(strip.convert('L').histogram()):
+            histogram[value] += count
+    return histogram
+
+
+def _run_segment(steps, img, strip_height):
+    """
+    Run steps over an RGB image in horizontal strips, writing back in place
+
+    Each strip is read with ``halo`` extra rows above and below so blur and
+    sharpen see the same neighbourhood as on the whole image. Because strips
+    are written back as they finish, the original rows the next strip's upper
+    halo needs are kept aside before being overwritten.
+    """
+    if not steps:
+        return
+    width, height = img.size
+    halo = sum(getattr(step, 'halo', 0) for step in steps)
+    # The rows kept aside come from the previous strip only
+    strip_height = max(strip_height, halo)
+    carry = None
+
+    for top in range(0, height, strip_height):
+        bottom = min(height, top + strip_height)
+        region_top = max(0, top - halo)
+        region_bottom = min(height, bottom + halo)
+
+        region = img.crop((0, top, width, region_bottom))
+        if carry is not None:
+            # Prepend the untouched rows above this strip
+            joined = PILImage.new('RGB', (width, region.height + carry.height))
+            joined.paste(carry, (0, 0))
+            joined.paste(region, (0, carry.height))
+            region = joined
+        carry = img.crop((0, max(top, bottom - halo), width, bottom)) if halo else None
+
+        box = (0, region_top, width, region_bottom)
+        for step in steps:
+            if isinstance(step, VignetteStep):
+                region = step.apply_region(region, box, (width, height))
+            else:
+                region = step.apply(region)
+
+        img.paste(region.crop((0, top - region_top, width, bottom - region_top)), (0, top))
+
+
+def run_plan_tiled(plan, img, strip_height=None):
+    """
+    Run a compiled plan in horizontal strips to bound intermediate memory
+
+    Every step works on one strip (plus a bounded overlap for blur and
+    sharpen) and the output is written back into the decoded image, so no
+    full-size intermediate copies are made. The result is the same as
+    run_plan's, except that each strip's vignette mask is resampled on its
+    own: pixels of a vignetted image may differ by 1 level (2 at full
+    strength).
+    Contrast, which depends on the mean of its whole input, splits the plan:
+    steps before it are run first, then its lookup table is built from a
+    strip-by-strip histogram.
+
+    Args:
+        plan (tuple): Plan returned by compile_settings
+        img (PIL.Image.Image): Image in any mode; RGB images are modified in place
+        strip_height (int, optional): Rows per strip. Defaults to TILE_STRIP_HEIGHT
+
+    Returns:
+        PIL.Image.Image: Filtered RGB image
+    """
+    strip_height = strip_height or TILE_STRIP_HEIGHT
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    segment = []
+    for step in plan:
+        if isinstance(step, ContrastStep):
+            _run_segment(segment, img, strip_height)
+            segment = [LutStep(step.name, step.lut_for(_l_histogram(img, strip_height)))]
+        else:
+            segment.append(step)
+    _run_segment(segment, img, strip_height)
+    return img
+
+
+def should_tile(img):
+    """Return True when an image is large enough to be processed in strips"""
+    return img.width * img.height >= TILED_MIN_PIXELS
+
+
+def apply_plan(plan, img):
+    """Run a plan, in strips for large images; RGB inputs may be modified in place"""
+    if should_tile(img):
+        return run_plan_tiled(plan, img)
+    return run_plan(plan, img)
+
+
+def split_alpha(img, keep=True):
+    """
+    Separate an image's transparency from its colour channels
+
+    Filters work on RGB, so the alpha channel is taken off before filtering
+    and put back afterwards. When it is not kept, transparent areas are
+    flattened onto white instead.
+
+    Returns:
+        tuple: (image without alpha, alpha channel or None)
+    """
+    if img.mode == 'P' and 'transparency' in img.info:
+        img = img.convert('RGBA')
+    if 'A' not in img.getbands():
+        return img, None
+
+    alpha = img.getchannel('A')
+    if keep:
+        return img.convert('RGB'), alpha
+    background = PILImage.new('RGB', img.size, (255, 255, 255))
+    background.paste(img.convert('RGB'), mask=alpha)
+    return background, None
+
+
+def make_renditions(img, sizes=None, output_options=None, source_size=None):
+    """
+    Encode downscaled copies of an image for previews and list views
+
+    Renditions are made largest first, each resampled from the previous one
+    rather than from the full image. Sizes at or above the source's longest
+    side are skipped, since they would only encode the image again at its
+    own size.
+
+    Args:
+        img (PIL.Image.Image): Decoded image
+        sizes (tuple, optional): Longest side of each rendition. Defaults to
+            RENDITION_SIZES
+        output_options (dict, optional): Encoding options. Defaults to
+            RENDITION_OUTPUT
+        source_size (int, optional): Longest side of the source image, when
+            img was decoded at a reduced size. Defaults to img's longest side
+
+    Returns:
+        dict: Encoded renditions keyed by size (as a string, for JSON)
+    """
+    sizes = RENDITION_SIZES if sizes is None else sizes
+    output_options = output_options or RENDITION_OUTPUT
+    source_size = source_size or max(img.size)
+    renditions = {}
+    for size in sorted(sizes, reverse=True):
+        if size >= source_size:
+            continue
+        img = fit_image(img, size)
+        renditions[str(size)] = encoders.encode(img, output_options)
+    return renditions
+
+
+def render(img, filter_settings, output_options=None, rendition_sizes=()):
+    """
+    Filter a decoded image and encode the result
+
+    Args:
+        img (PIL.Image.Image): Decoded image; it may be modified in place
+        filter_settings (dict or list): Filter settings
+        output_options (dict, optional): Options accepted by
+            encoders.parse_output_options
+        rendition_sizes (tuple, optional): Also encode downscaled renditions
+            of the result at these sizes
+
+    Returns:
+        encoders.EncodedImage: Encoded result, with ``renditions`` set when
+        rendition sizes were given
+    """
+    output_options = output_options or {}
+    with metrics.timer('stage_duration_seconds', stage='filter', filter=filter_type(filter_settings)):
+        img, alpha = split_alpha(img, encoders.supports_alpha(output_options))
+        img = apply_plan(compile_settings(filter_settings), img)
+        if alpha is not None:
+            img.putalpha(alpha)
+    with metrics.timer('stage_duration_seconds', stage='encode'):
+        encoded = encoders.encode(img, output_options)
+    if rendition_sizes:
+        with metrics.timer('stage_duration_seconds', stage='renditions'):
+            encoded = encoded._replace(renditions=make_renditions(img, rendition_sizes))
+    return encoded
+
+
+def render_original(image_data, specs, rendition_sizes=()):
+    """
+    Decode an original once and render several results from it
+
+    Takes and returns only picklable values, so it can run in a worker
+    process of a pipelined worker.
+
+    Args:
+        image_data (bytes): Encoded original
+        specs (list): (filter settings, max dimension, output options) per result
+        rendition_sizes (tuple, optional): Renditions to encode with each result
+
+    Returns:
+        list: An encoders.EncodedImage per spec, or the exception that spec raised
+
+    Raises:
+        Exception: If the original cannot be decoded
+    """
+    # Decode once, large enough for the biggest requested output
+    limits = [max_dimension for _, max_dimension, _ in specs]
+    decoded = decode_image(image_data, None if None in limits else max(limits))
+    decoded.load()
+    del image_data
+
+    results = []
+    for index, (filter_settings, max_dimension, output_options) in enumerate(specs):
+        try:
+            # Plans may work in place, so copy the decoded image while a
+            # later spec still needs it
+            img = fit_image(decoded, max_dimension)
+            if img is decoded and index < len(specs) - 1:
+                img = decoded.copy()
+            results.append(render(img, filter_settings, output_options, rendition_sizes))
+        except Exception as e:
+            results.append(e)
+    # Filter processes have no task or request hook to flush their metrics
+    metrics.flush()
+    return results
+
+
+def vignette_mask(width, height, level=0.3, box=None):
+    """
+    Build the darkening mask for a vignette of the given size and strength
+
+    The mask value at distance ``d`` from the centre is
+    ``int(255 * min(1, d / radius) * level)`` with ``radius = min(width, height) // 2``.
+    It is produced by scaling Pillow's radial gradient instead of evaluating
+    every pixel, and matches the exact formula to within 1 level at the default
+    strength (4 levels at full strength).
+
+    Whole-image masks are memoized per (width, height, level); callers must
+    not modify the returned image. Region masks are built on every call, so
+    the strips of a tiled image do not push whole-image masks out of the
+    cache.
+
+    Args:
+        width (int): Image width in pixels
+        height (int): Image height in pixels
+        level (float, optional): Darkening at the edges, 0 to 1. Defaults to 0.3
+        box (tuple, optional): (left, top, right, bottom) region of the mask
+            to build, for tiled processing. Defaults to the whole image
+
+    Returns:
+        PIL.Image.Image: Mode "L" mask where 255 means fully darkened
+    """
+    if box is None:
+        return _whole_vignette_mask(width, height, level)
+    return _build_vignette_mask(width, height, level, box)
+
+
+@lru_cache(maxsize=VIGNETTE_MASK_CACHE_SIZE)
+def _whole_vignette_mask(width, height, level):
+    return _build_vignette_mask(width, height, level, (0, 0, width, height))
+
+
+def _build_vignette_mask(width, height, level, box):
+    left, top, right, bottom = box
+    radius = max(1, min(width, height) // 2)
+    disc_left, disc_top = width // 2 - radius, height // 2 - radius
+
+    # Distances beyond the radius are clamped, so start from a fully dark canvas
+    # and paste the part of the scaled gradient disc that overlaps the region
+    gradient = PILImage.new('L', (right - left, bottom - top), 255)
+    x0, y0 = max(left, disc_left), max(top, disc_top)
+    x1, y1 = min(right, disc_left + 2 * radius), min(bottom, disc_top + 2 * radius)
+    if x0 < x1 and y0 < y1:
+        scale = _GRADIENT.width / (2 * radius)
+        source_box = ((x0 - disc_left) * scale, (y0 - disc_top) * scale,
+                      (x1 - disc_left) * scale, (y1 - disc_top) * scale)
+        disc = _GRADIENT.resize((x1 - x0, y1 - y0), PILImage.BILINEAR, box=source_box)
+        gradient.paste(disc, (x0 - left, y0 - top))
+
+    lut = [int(255 * min(1.0, value / _GRADIENT_EDGE) * level) for value in range(256)]
+    return gradient.point(lut)
+
+
+def _apply_vignette(img, level):
+    """Darken an RGB image towards its edges in place"""
+    mask = vignette_mask(img.width, img.height, level)
+    img.paste((0, 0, 0), None, mask)
+    return img
+
+
+def add_vignette(img, level=0.3):
+    """
+    Darken the edges of an image with a radial vignette
+
+    Args:
+        img (PIL.Image.Image): Image in any mode
+        level (float, optional): Darkening at the edges, 0 to 1. Defaults to 0.3
+
+    Returns:
+        PIL.Image.Image: New RGB image
+    """
+    return _apply_vignette(img.convert('RGB'), level)
@@ -0,0 +1,196 @@
+"""
+In-process metrics with a Prometheus text exporter
+
+Every process (the Flask app, each Celery worker process and each filter
+process of a pipelined worker) records into its own registry and adds its
+deltas to a shared Redis hash every METRICS_FLUSH_INTERVAL seconds. The
+/metrics endpoint reads that hash, so it reports totals across all of them.
+
+Gauges of shared state are not kept as deltas: a process that is killed
+never takes back what it added. The endpoint computes them at scrape time
+(images_in_progress comes from the database) and passes them to render().
+"""
+import os
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+
+import redis
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 10))
+METRICS_REDIS_KEY = os.getenv('METRICS_REDIS_KEY', 'artyfy:metrics')
+METRICS_PREFIX = 'artyfy_'
+
+# Latency buckets in seconds, from a cache hit to a very large original
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Transfer rate buckets in bytes per second, from 100 KB/s to 1 GB/s
+THROUGHPUT_BUCKETS = (1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8, 5e8, 1e9)
+
+# Every metric by name: (type, help text, histogram buckets)
+METRICS = {
+    'stage_duration_seconds': (
+        'histogram', "Time spent in each processing stage; filter timings are labelled by filter type",
+        LATENCY_BUCKETS),
+    'images_completed_total': (
+        'counter', "Filtered images completed, by whether they were rendered or reused from the cache", None),
+    'images_failed_total': ('counter', "Filtered images that failed, by reason", None),
+    'images_cancelled_total': ('counter', "Filtered images dropped because their job was cancelled", None),
+    'images_in_progress': ('gauge', "Filtered images currently being processed", None),
+    'bytes_downloaded_total': ('counter', "Bytes downloaded from storage", None),
+    'bytes_uploaded_total': ('counter', "Bytes uploaded to storage", None),
+    'transfer_rate_bytes_per_second': (
+        'histogram', "Storage transfer rate per object, by direction", THROUGHPUT_BUCKETS),
+    'original_cache_requests_total': ('counter', "Worker original cache lookups, by result", None),
+    'storage_cache_requests_total': ('counter', "Storage disk cache lookups, by result", None),
+    'http_request_duration_seconds': (
+        'histogram', "API request latency by endpoint and status code", LATENCY_BUCKETS),
+}
+
+_pending = {}
+_pending_pid = os.getpid()
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+_redis = None
+_redis_pid = None
+
+
+def _client():
+    global _redis, _redis_pid
+    if _redis is None or _redis_pid != os.getpid():
+        url = os.getenv('REDIS_URL') or os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/0')
+        _redis = redis.Redis.from_url(url)
+        _redis_pid = os.getpid()
+    return _redis
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    return ','.join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items()) if value != '')
+
+
+def _add(field, amount):
+    global _pending, _pending_pid
+    with _lock:
+        if _pending_pid != os.getpid():
+            # Deltas inherited through fork belong to the parent, which flushes them
+            _pending = {}
+            _pending_pid = os.getpid()
+        _pending[field] = _pending.get(field, 0) + amount
+
+
+def inc(name, amount=1, **labels):
+    """Add to a counter, or to a gauge (use a negative amount to decrease it)"""
+    if METRICS_ENABLED and amount:
+        _add(f"{name}|{_labels(labels)}|", amount)
+
+
+def observe(name, value, **labels):
+    """Record one observation in a histogram"""
+    if not METRICS_ENABLED:
+        return
+    base = f"{name}|{_labels(labels)}|"
+    for bound in METRICS[name][2]:
+        if value <= bound:
+            _add(f"{base}{bound}", 1)
+    _add(f"{base}+Inf", 1)
+    _add(f"{base}sum", value)
+
+
+@contextmanager
+def timer(name, **labels):
+    """Time the enclosed block into a histogram"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def flush(force=False):
+    """
+    Add this process's pending deltas to the shared totals in Redis
+
+    Only flushes every METRICS_FLUSH_INTERVAL seconds unless forced, so it
+    is cheap to call after every task or request. Deltas are kept for the
+    next attempt if Redis is unavailable.
+    """
+    global _pending, _last_flush
+    if not METRICS_ENABLED:
+        return
+    now = time.monotonic()
+    with _lock:
+        if not _pending or _pending_pid != os.getpid() or (
+                not force and now - _last_flush < METRICS_FLUSH_INTERVAL):
+            return
+        pending, _pending = _pending, {}
+        _last_flush = now
+
+    try:
+        pipe = _client().pipeline(transaction=False)
+        for field, amount in pending.items():
+            pipe.hincrbyfloat(METRICS_REDIS_KEY, field, amount)
+        pipe.execute()
+    except Exception as e:
+        print(f"Error flushing metrics: {str(e)}")
+        for field, amount in pending.items():
+            _add(field, amount)
+
+
+atexit.register(flush, force=True)
+
+
+def _number(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def render(gauges=None):
+    """
+    Return the shared totals in the Prometheus text exposition format
+
+    Args:
+        gauges: Values computed at scrape time by metric name; they replace
+            anything stored under the same name in Redis
+
+    Returns:
+        The exposition text
+    """
+    flush(force=True)
+    gauges = gauges or {}
+    samples = {}
+    for field, value in _client().hgetall(METRICS_REDIS_KEY).items():
+        name, labels, suffix = field.decode().split('|', 2)
+        if name in METRICS and name not in gauges:
+            samples.setdefault(name, []).append((labels, suffix, value.decode()))
+    for name, value in gauges.items():
+        samples[name] = [('', '', value)]
+
+    lines = []
+    for name in sorted(samples):
+        kind, help_text, buckets = METRICS[name]
+        full_name = METRICS_PREFIX + name
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} {kind}")
+        if kind != 'histogram':
+            for labels, _, value in sorted(samples[name]):
+                lines.append(f"{full_name}{{{labels}}} {_number(value)}" if labels
+                             else f"{full_name} {_number(value)}")
+            continue
+
+        series = {}
+        for labels, suffix, value in samples[name]:
+            series.setdefault(labels, {})[suffix] = value
+        for labels, values in sorted(series.items()):
+            prefix = f"{labels}," if labels else ''
+            for bound in [*(str(b) for b in buckets), '+Inf']:
+                lines.append(f'{full_name}_bucket{{{prefix}le="{bound}"}} {_number(values.get(bound, 0))}')
+            suffix = f"{{{labels}}}" if labels else ''
+            lines.append(f"{full_name}_sum{suffix} {_number(values.get('sum', 0))}")
+            lines.append(f"{full_name}_count{suffix} {_number(values.get('+Inf', 0))}")
+    return '\n'.join(lines) + '\n'
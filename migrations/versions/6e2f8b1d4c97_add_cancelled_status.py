@@ -0,0 +1,28 @@
+"""Add cancelled processing status
+
+Revision ID: 6e2f8b1d4c97
+Revises: 0c9d5a7e3f12
+Create Date: 2026-10-17 15:03:12.418730
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e2f8b1d4c97'
+down_revision = '0c9d5a7e3f12'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # ALTER TYPE ... ADD VALUE cannot run inside a transaction block
+    with op.get_context().autocommit_block():
+        op.execute("ALTER TYPE processingstatus ADD VALUE IF NOT EXISTS 'CANCELLED'")
+
+
+def downgrade() -> None:
+    # Postgres cannot drop an enum value; record cancelled rows as failed instead
+    op.execute("UPDATE filtered_images SET status = 'FAILED' WHERE status = 'CANCELLED'")
+    op.execute("UPDATE filter_jobs SET status = 'FAILED' WHERE status = 'CANCELLED'")
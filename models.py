@@ -12,6 +12,7 @@ class ProcessingStatus(enum.Enum):
     PROCESSING = "processing"
     COMPLETED = "completed"
     FAILED = "failed"
+    CANCELLED = "cancelled"
 
 class User(db.Model):
     __tablename__ = 'users'
@@ -53,6 +54,18 @@ class Image(db.Model):
     id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = db.Column(UUID(as_uuid=True), db.ForeignKey('users.id'), nullable=False)
     original_url = db.Column(db.String(512), nullable=False)
+    # Where the original is stored; workers read it from here, not from the URL
+    storage_bucket = db.Column(db.String(255), nullable=True)
+    storage_key = db.Column(db.String(1024), nullable=True)
+    # SHA-256 of the original's bytes, recorded the first time a worker downloads it
+    content_hash = db.Column(db.String(64), nullable=True, index=True)
+    # Size of the original in bytes, recorded alongside content_hash
+    file_size = db.Column(db.BigInteger, nullable=True)
+    # Dimensions of the original, read from its header on first download
+    width = db.Column(db.Integer, nullable=True)
+    height = db.Column(db.Integer, nullable=True)
+    # Preview rendition URLs keyed by longest side in pixels, e.g. {"128": url}
+    renditions = db.Column(JSON, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -66,10 +79,19 @@ class FilteredImage(db.Model):
     image_id = db.Column(UUID(as_uuid=True), db.ForeignKey('images.id'), nullable=False)
     filter_id = db.Column(UUID(as_uuid=True), db.ForeignKey('filters.id'), nullable=False)
     result_url = db.Column(db.String(512), nullable=True)
+    # Where the result is stored, set with result_url
+    storage_bucket = db.Column(db.String(255), nullable=True)
+    storage_key = db.Column(db.String(1024), nullable=True)
+    renditions = db.Column(JSON, nullable=True)
     status = db.Column(SQLAlchemyEnum(ProcessingStatus), nullable=False, default=ProcessingStatus.PENDING)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     filter_job_id = db.Column(UUID(as_uuid=True), db.ForeignKey('filter_jobs.id'), nullable=True)
+    # When the bulk scheduler last queued this image for a worker
+    dispatched_at = db.Column(db.DateTime, nullable=True, index=True)
+    # The task processing this image and when its claim lapses
+    lease_owner = db.Column(db.String(32), nullable=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True, index=True)
 
 class FilterJob(db.Model):
     __tablename__ = 'filter_jobs'
@@ -77,11 +99,28 @@ class FilterJob(db.Model):
     id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = db.Column(UUID(as_uuid=True), db.ForeignKey('users.id'), nullable=False)
     filter_id = db.Column(UUID(as_uuid=True), db.ForeignKey('filters.id'), nullable=False)
+    # All filters of a multi-filter job, in request order (filter_id is the first)
+    filter_ids = db.Column(JSON, nullable=True)
     status = db.Column(SQLAlchemyEnum(ProcessingStatus), nullable=False, default=ProcessingStatus.PENDING)
     image_count = db.Column(db.Integer, default=0)
     completed_count = db.Column(db.Integer, default=0)
+    failed_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    options = db.Column(JSON, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relationships
     filtered_images = db.relationship('FilteredImage', backref='filter_job', lazy=True)
+
+class ResultCache(db.Model):
+    __tablename__ = 'result_cache'
+    
+    # Hash of (original content, filter settings, output options)
+    cache_key = db.Column(db.String(64), primary_key=True)
+    result_url = db.Column(db.String(512), nullable=False)
+    # Where the result is stored, copied to the filtered images that reuse it
+    storage_bucket = db.Column(db.String(255), nullable=True)
+    storage_key = db.Column(db.String(1024), nullable=True)
+    content_type = db.Column(db.String(64), nullable=False)
+    renditions = db.Column(JSON, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -1,120 +1,715 @@
+"""
+Object storage shared by the API and the Celery workers
+
+Files live in an S3 bucket or, with STORAGE_BACKEND=local, in a directory
+on local disk (for development, tests and benchmarks without a network).
+The module-level functions work the same with either backend.
+
+Every process uses one S3 client, created on first use so that importing
+this module opens no connections. The client is rebuilt when the process id
+changes, so prefork Celery workers never share the parent's connection pool.
+The pool is sized for the threads that upload and download concurrently
+(see PIPELINE_IO_THREADS and GROUP_UPLOAD_CONCURRENCY).
+
+Transfers stream: downloads are written to their destination as they
+arrive, and objects over S3_MULTIPART_THRESHOLD_MB are fetched as parallel
+ranged GETs and stored as multipart uploads of S3_MULTIPART_CHUNKSIZE_MB
+parts, S3_TRANSFER_CONCURRENCY at a time.
+
+With STORAGE_CACHE_DIR set, files opened with open_file are kept in that
+directory, up to STORAGE_CACHE_MB, and read from there the next time.
+"""
+import io
 import os
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import mimetypes
+import tempfile
+import threading
+from collections import namedtuple
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import NoCredentialsError
-import uuid
 from dotenv import load_dotenv
 from werkzeug.utils import secure_filename
-from flask import current_app
+
+import metrics
+from encoders import OUTPUT_FORMATS
 
 # Load environment variables
 load_dotenv()
 
-# Initialize S3 client
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=os.getenv('S3_ACCESS_KEY'),
-    aws_secret_access_key=os.getenv('S3_SECRET_KEY'),
-    region_name=os.getenv('S3_REGION'),
-    endpoint_url=os.getenv('S3_ENDPOINT')
+logger = logging.getLogger(__name__)
+
+# "s3" or "local"
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 's3')
+LOCAL_STORAGE_ROOT = os.path.abspath(os.getenv('LOCAL_STORAGE_ROOT', 'storage'))
+# Where clients can fetch locally stored files, e.g. from a static file server
+LOCAL_STORAGE_URL = os.getenv('LOCAL_STORAGE_URL', f"file://{LOCAL_STORAGE_ROOT}")
+
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', 32))
+S3_MAX_ATTEMPTS = int(os.getenv('S3_MAX_ATTEMPTS', 5))
+S3_RETRY_MODE = os.getenv('S3_RETRY_MODE', 'standard')
+S3_CONNECT_TIMEOUT = float(os.getenv('S3_CONNECT_TIMEOUT', 5))
+S3_READ_TIMEOUT = float(os.getenv('S3_READ_TIMEOUT', 60))
+
+MB = 1024 * 1024
+S3_MULTIPART_THRESHOLD = int(float(os.getenv('S3_MULTIPART_THRESHOLD_MB', 16)) * MB)
+S3_MULTIPART_CHUNKSIZE = int(float(os.getenv('S3_MULTIPART_CHUNKSIZE_MB', 8)) * MB)
+S3_TRANSFER_CONCURRENCY = int(os.getenv('S3_TRANSFER_CONCURRENCY', 4))
+# Files opened with open_file stay in memory up to this size and spill to disk beyond it
+S3_SPOOL_MB = float(os.getenv('S3_SPOOL_MB', 16))
+
+# Read-through disk cache for open_file, off unless a directory is given
+STORAGE_CACHE_DIR = os.getenv('STORAGE_CACHE_DIR')
+STORAGE_CACHE_MB = float(os.getenv('STORAGE_CACHE_MB', 1024))
+
+# Size of the reads that copy a response body into its destination
+STREAM_CHUNK_SIZE = 256 * 1024
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD,
+    multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+    max_concurrency=S3_TRANSFER_CONCURRENCY,
 )
 
+# Where upload_file stored a file
+StoredFile = namedtuple('StoredFile', ['url', 'bucket', 'key'])
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return this process's S3 client, creating it on first use"""
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                # A session of our own: creating clients from boto3's default
+                # session is not thread-safe
+                _client = boto3.session.Session().client(
+                    's3',
+                    aws_access_key_id=os.getenv('S3_ACCESS_KEY'),
+                    aws_secret_access_key=os.getenv('S3_SECRET_KEY'),
+                    region_name=os.getenv('S3_REGION'),
+                    endpoint_url=os.getenv('S3_ENDPOINT'),
+                    config=Config(
+                        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                        retries={'total_max_attempts': S3_MAX_ATTEMPTS, 'mode': S3_RETRY_MODE},
+                        connect_timeout=S3_CONNECT_TIMEOUT,
+                        read_timeout=S3_READ_TIMEOUT,
+                    ),
+                )
+                _client_pid = pid
+    return _client
+
+
+def _body_size(body):
+    """Length of the bytes or seekable file to upload, from its current position"""
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        return len(body)
+    position = body.tell()
+    size = body.seek(0, io.SEEK_END) - position
+    body.seek(position)
+    return size
+
+def _copy_body(body, fileobj, offset, lock=None):
+    """Write a streaming response body into fileobj at offset; returns the bytes written"""
+    written = 0
+    for piece in iter(lambda: body.read(STREAM_CHUNK_SIZE), b''):
+        if lock is None:
+            fileobj.seek(offset + written)
+            fileobj.write(piece)
+        else:
+            with lock:
+                fileobj.seek(offset + written)
+                fileobj.write(piece)
+        written += len(piece)
+    return written
+
+
+class S3Backend:
+    """Files in an S3 bucket, reached through this process's shared client"""
+
+    # Clients can upload straight to the bucket with presigned URLs
+    direct_uploads = True
+
+    def __init__(self, bucket_name, endpoint):
+        self.bucket_name = bucket_name
+        self.endpoint = endpoint
+
+    def url(self, key, bucket=None):
+        return f"{self.endpoint}/{bucket or self.bucket_name}/{key}"
+
+    def key_for_url(self, url):
+        prefix = f"{self.endpoint}/{self.bucket_name}/"
+        if self.endpoint and url.startswith(prefix) and len(url) > len(prefix):
+            return url[len(prefix):]
+        return None
+
+    def put(self, key, body, size, content_type):
+        """Store bytes or a seekable file, as a multipart upload over S3_MULTIPART_THRESHOLD"""
+        if size < S3_MULTIPART_THRESHOLD:
+            get_client().put_object(
+                Bucket=self.bucket_name,
+                Key=key,
+                Body=body,
+                ContentType=content_type
+            )
+            return
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            body = io.BytesIO(body)
+        get_client().upload_fileobj(
+            body, self.bucket_name, key,
+            ExtraArgs={'ContentType': content_type},
+            Config=TRANSFER_CONFIG
+        )
+
+    def get(self, key, fileobj, bucket=None):
+        """
+        Stream an object into a seekable file object
+
+        The first request asks for up to S3_MULTIPART_THRESHOLD bytes, so small
+        objects take a single GET and no HEAD. Whatever is left of a larger
+        object is fetched as S3_MULTIPART_CHUNKSIZE ranges in parallel.
+
+        Returns:
+            int: Size of the object
+        """
+        client = get_client()
+        bucket = bucket or self.bucket_name
+        response = client.get_object(Bucket=bucket, Key=key,
+                                     Range=f"bytes=0-{S3_MULTIPART_THRESHOLD - 1}")
+        received = _copy_body(response['Body'], fileobj, 0)
+        # "bytes 0-999/5000"; absent when the whole object was returned
+        content_range = response.get('ContentRange')
+        size = int(content_range.rsplit('/', 1)[1]) if content_range else received
+        if received >= size:
+            return size
+
+        lock = threading.Lock()
+
+        def fetch(start):
+            end = min(start + S3_MULTIPART_CHUNKSIZE, size) - 1
+            part = client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}")
+            return _copy_body(part['Body'], fileobj, start, lock)
+
+        with ThreadPoolExecutor(max_workers=S3_TRANSFER_CONCURRENCY) as pool:
+            received += sum(pool.map(fetch, range(received, size, S3_MULTIPART_CHUNKSIZE)))
+        if received != size:
+            raise IOError(f"Downloaded {received} of {size} bytes of {key}")
+        return size
+
+    def open(self, key, bucket=None):
+        """Download an object into a temporary file, in memory up to S3_SPOOL_MB"""
+        spool = SpooledTemporaryFile(max_size=int(S3_SPOOL_MB * MB))
+        try:
+            self.get(key, spool, bucket)
+        except Exception:
+            spool.close()
+            raise
+        spool.seek(0)
+        return spool
+
+    def head(self, key, bucket=None):
+        response = get_client().head_object(Bucket=bucket or self.bucket_name, Key=key)
+        return {'size': response['ContentLength'], 'content_type': response.get('ContentType')}
+
+    def delete(self, key, bucket=None):
+        get_client().delete_object(Bucket=bucket or self.bucket_name, Key=key)
+
+    def presign_upload(self, key, content_type, size, expires_in):
+        client = get_client()
+        if size < S3_MULTIPART_THRESHOLD:
+            url = client.generate_presigned_url(
+                'put_object',
+                Params={'Bucket': self.bucket_name, 'Key': key, 'ContentType': content_type},
+                ExpiresIn=expires_in
+            )
+            return {'url': url}
+
+        # S3 allows at most 10000 parts, each of at least 5 MB but the last
+        part_size = max(S3_MULTIPART_CHUNKSIZE, 5 * MB, -(-size // 10000))
+        upload_id = client.create_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=key,
+            ContentType=content_type
+        )['UploadId']
+        parts = [
+            {
+                'part_number': number,
+                'url': client.generate_presigned_url(
+                    'upload_part',
+                    Params={'Bucket': self.bucket_name, 'Key': key, 'UploadId': upload_id,
+                            'PartNumber': number},
+                    ExpiresIn=expires_in
+                ),
+            }
+            for number in range(1, -(-size // part_size) + 1)
+        ]
+        return {'upload_id': upload_id, 'part_size': part_size, 'parts': parts}
+
+    def complete_upload(self, key, upload_id, parts):
+        get_client().complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': etag} for number, etag in sorted(parts)]}
+        )
+
+    def abort_upload(self, key, upload_id):
+        get_client().abort_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id)
+
+
+class LocalBackend:
+    """Files in a directory on local disk, served from LOCAL_STORAGE_URL"""
+
+    direct_uploads = False
+    # Everything is under one root
+    bucket_name = None
+
+    def __init__(self, root, base_url):
+        self.root = root
+        self.base_url = base_url.rstrip('/')
+
+    def _path(self, key):
+        path = os.path.realpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.realpath(self.root) + os.sep):
+            raise ValueError(f"Invalid storage key: {key}")
+        return path
+
+    def url(self, key, bucket=None):
+        return f"{self.base_url}/{key}"
+
+    def key_for_url(self, url):
+        prefix = f"{self.base_url}/"
+        if url.startswith(prefix) and len(url) > len(prefix):
+            return url[len(prefix):]
+        return None
+
+    def put(self, key, body, size, content_type):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write beside the destination and rename, so readers never see part of a file
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.upload-', delete=False) as f:
+            if isinstance(body, (bytes, bytearray, memoryview)):
+                f.write(body)
+            else:
+                shutil.copyfileobj(body, f, STREAM_CHUNK_SIZE)
+        os.replace(f.name, path)
+
+    def get(self, key, fileobj, bucket=None):
+        with open(self._path(key), 'rb') as f:
+            return _copy_body(f, fileobj, 0)
+
+    def open(self, key, bucket=None):
+        return open(self._path(key), 'rb')
+
+    def head(self, key, bucket=None):
+        return {'size': os.path.getsize(self._path(key)), 'content_type': mimetypes.guess_type(key)[0]}
+
+    def delete(self, key, bucket=None):
+        os.remove(self._path(key))
+
+
+class DiskCache:
+    """
+    Read-through cache of downloaded files in a local directory
+
+    Processes on one host can share the directory. Each file is named after
+    a hash of its key and written under a temporary name first, so readers
+    only ever see complete files. Opening a file marks it as recently used.
+    Once a process has added more than max_bytes by its own count, it
+    evicts the least recently used files until the directory is back to 90%
+    of max_bytes. Files over a quarter of max_bytes are never kept.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def open(self, key):
+        """Return the cached file for key, opened for reading, or None"""
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            # Evicted by another process; the open file stays readable
+            pass
+        return f
+
+    def fill(self, key, download):
+        """
+        Download a file into the cache and return it opened for reading
+
+        Args:
+            key (str): Storage key of the file
+            download (callable): Writes the file into the file object it is given and returns its size
+        """
+        with tempfile.NamedTemporaryFile(dir=self.directory, prefix='.download-', delete=False) as f:
+            try:
+                size = download(f)
+            except Exception:
+                f.close()
+                os.unlink(f.name)
+                raise
+        cached = open(f.name, 'rb')
+        if size > self.max_bytes // 4:
+            # Too large to keep: the open file is all the caller needs
+            os.unlink(f.name)
+            return cached
+        os.replace(f.name, self._path(key))
+        self._added(size)
+        return cached
+
+    def _added(self, size):
+        with self._lock:
+            if self._size is None:
+                # The scan already counts the file just added
+                self._size = self._scan()[1]
+            else:
+                self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _scan(self):
+        entries, total = [], 0
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.startswith('.'):
+                # Left behind by a process that died mid-download
+                if time.time() - stat.st_mtime > 3600:
+                    try:
+                        os.unlink(entry.path)
+                    except OSError:
+                        pass
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        return entries, total
+
+    def _evict(self):
+        entries, total = self._scan()
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._size = total
+
+
+_backend = None
+_disk_cache = None
+_disk_cache_pid = None
+
+
+def get_backend():
+    """Return the storage backend chosen by STORAGE_BACKEND"""
+    global _backend
+    if _backend is None:
+        if STORAGE_BACKEND == 's3':
+            _backend = S3Backend(os.getenv('S3_BUCKET_NAME'), os.getenv('S3_ENDPOINT'))
+        elif STORAGE_BACKEND == 'local':
+            _backend = LocalBackend(LOCAL_STORAGE_ROOT, LOCAL_STORAGE_URL)
+        else:
+            raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+    return _backend
+
+def get_disk_cache():
+    """Return this process's disk cache, or None when STORAGE_CACHE_DIR is not set"""
+    global _disk_cache, _disk_cache_pid
+    if STORAGE_CACHE_DIR and _disk_cache_pid != os.getpid():
+        _disk_cache = DiskCache(STORAGE_CACHE_DIR, int(STORAGE_CACHE_MB * MB))
+        _disk_cache_pid = os.getpid()
+    return _disk_cache
+
+def object_key(name):
+    """
+    Return the key to store a file name under
+
+    Keys start with two levels of hash prefix, e.g. "3f/a2/name.jpg", so
+    that requests spread evenly over the bucket's key space instead of all
+    landing on one partition.
+    """
+    digest = hashlib.sha256(name.encode()).hexdigest()
+    return f"{digest[:2]}/{digest[2:4]}/{name}"
+
+def bucket_name():
+    """Return the bucket new files are stored in (None for local storage)"""
+    return get_backend().bucket_name
+
+def file_url(key, bucket=None):
+    """Return the URL of the file stored under key"""
+    return get_backend().url(key, bucket)
+
+def key_for_url(file_url):
+    """
+    Return the key of a file URL in the configured bucket
+
+    Only URLs of the form file_url builds are recognised, so a URL that
+    names any other bucket or host is never read with this server's
+    credentials.
+
+    Returns:
+        str: Key of the file, or None if the URL is not in the configured bucket
+    """
+    return get_backend().key_for_url(file_url)
+
+def _location(file_url, bucket, key):
+    if key:
+        return bucket, key
+    key = key_for_url(file_url)
+    if key is None:
+        raise ValueError(f"Not a file in the storage bucket: {file_url}")
+    return None, key
+
+def _record_transfer(stage, size, seconds):
+    metrics.observe('stage_duration_seconds', seconds, stage=stage)
+    metrics.inc('bytes_uploaded_total' if stage == 'upload' else 'bytes_downloaded_total', size)
+    if seconds > 0:
+        metrics.observe('transfer_rate_bytes_per_second', size / seconds, direction=stage)
+
 def upload_file(file_data, filename=None, content_type='image/jpeg'):
     """
-    Upload a file to S3 bucket
-    
+    Upload a file to storage
+
+    The file is stored under object_key(filename). Files over
+    S3_MULTIPART_THRESHOLD are sent to S3 as a multipart upload.
+
     Args:
-        file_data (bytes): File data to upload
+        file_data (bytes or file): File data to upload, or a seekable file object to read it from
         filename (str, optional): Name to use for the file. If None, a random name will be generated
         content_type (str, optional): MIME type of the file. Defaults to 'image/jpeg'
-        
+
     Returns:
-        str: URL of the uploaded file, or None if upload failed
+        StoredFile: URL, bucket and key of the uploaded file, or None if upload failed
     """
     if filename is None:
         # Generate a unique filename
-        extension = 'jpg' if content_type == 'image/jpeg' else 'png'
+        extension = next(
+            (ext for _, ctype, ext, _ in OUTPUT_FORMATS.values() if ctype == content_type),
+            'png'
+        )
         filename = f"{uuid.uuid4()}.{extension}"
     else:
         # Secure the filename
         filename = secure_filename(filename)
-    
-    bucket_name = os.getenv('S3_BUCKET_NAME')
-    
+    key = object_key(filename)
+
     try:
-        s3_client.put_object(
-            Bucket=bucket_name,
-            Key=filename,
-            Body=file_data,
-            ContentType=content_type
-        )
-        
-        # Generate URL for the uploaded file
-        s3_endpoint = os.getenv('S3_ENDPOINT')
-        return f"{s3_endpoint}/{bucket_name}/{filename}"
-    
+        size = _body_size(file_data)
+        start = time.perf_counter()
+        get_backend().put(key, file_data, size, content_type)
+        _record_transfer('upload', size, time.perf_counter() - start)
+        return StoredFile(file_url(key), bucket_name(), key)
+
     except NoCredentialsError:
-        current_app.logger.error("S3 credentials not available")
+        logger.error("S3 credentials not available")
         return None
     except Exception as e:
-        current_app.logger.error(f"Error uploading file to S3: {str(e)}")
+        logger.error(f"Error uploading file to storage: {str(e)}")
         return None
 
-def download_file(file_url):
+def download_file(file_url, bucket=None, key=None):
     """
-    Download a file from S3 bucket
-    
+    Download a file from storage
+
     Args:
         file_url (str): Full URL of the file to download
-        
+        bucket (str, optional): Bucket the file is stored in, when known
+        key (str, optional): Key the file is stored under; found from file_url if not given
+
     Returns:
         bytes: File data, or None if download failed
     """
-    if not file_url:
+    if not file_url and not key:
         return None
-    
-    bucket_name = os.getenv('S3_BUCKET_NAME')
-    
+
+    if get_disk_cache() is not None:
+        source = open_file(file_url, bucket, key)
+        if source is None:
+            return None
+        with source:
+            return source.read()
+
     try:
-        # Extract file name from URL
-        filename = file_url.split('/')[-1]
-        
-        response = s3_client.get_object(
-            Bucket=bucket_name,
-            Key=filename
-        )
-        
-        return response['Body'].read()
-    
+        bucket, key = _location(file_url, bucket, key)
+        buffer = io.BytesIO()
+        start = time.perf_counter()
+        size = get_backend().get(key, buffer, bucket)
+        _record_transfer('download', size, time.perf_counter() - start)
+        return buffer.getvalue()
+
+    except Exception as e:
+        logger.error(f"Error downloading file from storage: {str(e)}")
+        return None
+
+def open_file(file_url, bucket=None, key=None):
+    """
+    Open a file from storage for reading
+
+    From S3, the file is downloaded into a temporary file that is held in
+    memory up to S3_SPOOL_MB and written to disk beyond that, so large files
+    never have to be held whole in memory. With STORAGE_CACHE_DIR set, the
+    file is read from the disk cache when it is there and added to it when
+    it is not.
+
+    Args:
+        file_url (str): Full URL of the file to open
+        bucket (str, optional): Bucket the file is stored in, when known
+        key (str, optional): Key the file is stored under; found from file_url if not given
+
+    Returns:
+        file: The file, positioned at its start, or None if it could not be read
+    """
+    if not file_url and not key:
+        return None
+
+    try:
+        bucket, key = _location(file_url, bucket, key)
+        backend = get_backend()
+        cache = get_disk_cache()
+        cache_key = f"{bucket}/{key}"
+        if cache is not None:
+            cached = cache.open(cache_key)
+            metrics.inc('storage_cache_requests_total', result='miss' if cached is None else 'hit')
+            if cached is not None:
+                return cached
+
+        start = time.perf_counter()
+        if cache is not None:
+            source = cache.fill(cache_key, lambda fileobj: backend.get(key, fileobj, bucket))
+        else:
+            source = backend.open(key, bucket)
+        size = source.seek(0, io.SEEK_END)
+        source.seek(0)
+        _record_transfer('download', size, time.perf_counter() - start)
+        return source
+
     except Exception as e:
-        current_app.logger.error(f"Error downloading file from S3: {str(e)}")
+        logger.error(f"Error downloading file from storage: {str(e)}")
         return None
 
-def delete_file(file_url):
+def delete_file(key, bucket=None):
     """
-    Delete a file from S3 bucket
-    
+    Delete a file from storage
+
     Args:
-        file_url (str): Full URL of the file to delete
-        
+        key (str): Key of the file to delete
+        bucket (str, optional): Bucket the file is stored in; the configured bucket if not given
+
     Returns:
         bool: True if deletion was successful, False otherwise
     """
-    if not file_url:
+    if not key:
         return False
-    
-    bucket_name = os.getenv('S3_BUCKET_NAME')
-    
+
     try:
-        # Extract file name from URL
-        filename = file_url.split('/')[-1]
-        
-        s3_client.delete_object(
-            Bucket=bucket_name,
-            Key=filename
-        )
-        
+        get_backend().delete(key, bucket)
         return True
-    
+
+    except Exception as e:
+        logger.error(f"Error deleting file from storage: {str(e)}")
+        return False
+
+def direct_uploads_supported():
+    """Return True if clients can upload straight to storage with presign_upload"""
+    return get_backend().direct_uploads
+
+def presign_upload(key, content_type, size, expires_in):
+    """
+    Prepare a client's direct upload of a file to storage
+
+    Files under S3_MULTIPART_THRESHOLD get a presigned PUT URL. Larger files
+    get a multipart upload with a presigned PUT URL for each part, which the
+    client uploads before calling complete_upload.
+
+    Args:
+        key (str): Key to store the file under
+        content_type (str): MIME type the client must send with a single PUT
+        size (int): Size of the file in bytes
+        expires_in (int): Seconds the URLs stay valid
+
+    Returns:
+        dict: ``url`` for a single PUT, or ``upload_id``, ``part_size`` and
+        ``parts`` (``part_number`` and ``url`` of each part) for a multipart
+        upload; None if the upload could not be prepared
+    """
+    try:
+        return get_backend().presign_upload(key, content_type, size, expires_in)
+
+    except Exception as e:
+        logger.error(f"Error preparing upload to storage: {str(e)}")
+        return None
+
+def complete_upload(key, upload_id, parts):
+    """
+    Assemble a multipart upload from its uploaded parts
+
+    Args:
+        key (str): Key the upload was prepared for
+        upload_id (str): Multipart upload ID from presign_upload
+        parts (list): (part number, ETag) of every uploaded part
+
+    Returns:
+        bool: True if the file was assembled, False otherwise
+    """
+    try:
+        get_backend().complete_upload(key, upload_id, parts)
+        return True
+
     except Exception as e:
-        current_app.logger.error(f"Error deleting file from S3: {str(e)}")
+        logger.error(f"Error completing upload to storage: {str(e)}")
         return False
+
+def abort_upload(key, upload_id):
+    """Discard a multipart upload and any parts already uploaded"""
+    try:
+        get_backend().abort_upload(key, upload_id)
+    except Exception as e:
+        logger.error(f"Error aborting upload to storage: {str(e)}")
+
+def head_file(key, bucket=None):
+    """
+    Read a file's size and MIME type without downloading it
+
+    Args:
+        key (str): Key of the file
+        bucket (str, optional): Bucket the file is stored in; the configured bucket if not given
+
+    Returns:
+        dict: ``size`` and ``content_type``, or None if there is no such file
+    """
+    try:
+        return get_backend().head(key, bucket)
+
+    except Exception as e:
+        logger.error(f"Error reading file metadata from storage: {str(e)}")
+        return None
@@ -1,15 +1,28 @@
 import os
 from celery import Celery
-from PIL import Image as PILImage
-from PIL import ImageOps, ImageFilter, ImageEnhance
+from celery.signals import task_postrun
+from kombu import Queue
 import io
 import json
 import uuid
-from datetime import datetime
-import boto3
-from botocore.exceptions import NoCredentialsError
+import hashlib
+import fcntl
+import tempfile
+from datetime import datetime, timedelta
+import redis
 from dotenv import load_dotenv
 import time
+import heapq
+import threading
+import multiprocessing
+from collections import deque, namedtuple, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+import filters
+import encoders
+import metrics
+import storage
 
 # Load environment variables
 load_dotenv()
@@ -19,239 +32,1408 @@ celery_app = Celery('artyfy')
 celery_app.conf.broker_url = os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/0')
 celery_app.conf.result_backend = os.getenv('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0')
 
-# Initialize S3 client
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=os.getenv('S3_ACCESS_KEY'),
-    aws_secret_access_key=os.getenv('S3_SECRET_KEY'),
-    region_name=os.getenv('S3_REGION'),
-    endpoint_url=os.getenv('S3_ENDPOINT')
+# Small jobs go to their own queue and worker pool so they never wait behind
+# a bulk job. A worker started without -Q consumes every queue.
+INTERACTIVE_QUEUE = os.getenv('INTERACTIVE_QUEUE', 'interactive')
+BULK_QUEUE = os.getenv('BULK_QUEUE', 'bulk')
+INTERACTIVE_MAX_IMAGES = int(os.getenv('INTERACTIVE_MAX_IMAGES', 5))
+
+# Admission control. Originals over filters.MAX_IMAGE_PIXELS are rejected
+# from their header alone, and those over LARGE_IMAGE_PIXELS are processed
+# only by workers on LARGE_QUEUE. The worker processes of a host decode at
+# most DECODE_MEMORY_MB of pixels at once between them, counted in
+# DECODE_BUDGET_FILE; a larger original still runs, alone.
+LARGE_QUEUE = os.getenv('LARGE_QUEUE', 'large')
+LARGE_IMAGE_PIXELS = int(os.getenv('LARGE_IMAGE_PIXELS', 40_000_000))
+DECODE_MEMORY_MB = float(os.getenv('DECODE_MEMORY_MB', 1024))
+DECODE_BUDGET_FILE = os.getenv('DECODE_BUDGET_FILE',
+                               os.path.join(tempfile.gettempdir(), 'artyfy-decode-budget.json'))
+# How often a process waiting for the budget checks it again, in seconds
+DECODE_BUDGET_POLL = float(os.getenv('DECODE_BUDGET_POLL', 0.1))
+
+celery_app.conf.task_queues = (
+    Queue(INTERACTIVE_QUEUE, routing_key=INTERACTIVE_QUEUE),
+    Queue(BULK_QUEUE, routing_key=BULK_QUEUE),
+    Queue(LARGE_QUEUE, routing_key=LARGE_QUEUE),
 )
+celery_app.conf.task_default_queue = BULK_QUEUE
+# Previews are shown right after upload, and starting and scheduling jobs
+# (bulk ones included) must not wait behind a bulk chunk
+celery_app.conf.task_routes = {
+    'generate_renditions': {'queue': INTERACTIVE_QUEUE},
+    'process_job': {'queue': INTERACTIVE_QUEUE},
+    'schedule_bulk_work': {'queue': INTERACTIVE_QUEUE},
+    'reclaim_expired_leases': {'queue': INTERACTIVE_QUEUE},
+}
+
+# Reuse results of identical (original, settings, output) renders
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+# Concurrent result uploads per multi-filter task
+GROUP_UPLOAD_CONCURRENCY = int(os.getenv('GROUP_UPLOAD_CONCURRENCY', 4))
+
+# Batch chunking: a chunk closes at this many bytes of originals or this many
+# filtered images; originals not yet downloaded are assumed to be the default size
+BATCH_MAX_BYTES = int(os.getenv('BATCH_MAX_BYTES', 64 * 1024 * 1024))
+BATCH_MAX_IMAGES = int(os.getenv('BATCH_MAX_IMAGES', 50))
+BATCH_DEFAULT_IMAGE_BYTES = int(os.getenv('BATCH_DEFAULT_IMAGE_BYTES', 4 * 1024 * 1024))
+
+# Bulk jobs are fed to the bulk queue a chunk at a time rather than queued
+# whole. At most SCHEDULER_MAX_IN_FLIGHT filtered images are queued or
+# processing at once, at most SCHEDULER_USER_MAX_IN_FLIGHT of them for one
+# user (less than the total, so no one user can hold every slot), and each
+# free slot goes to the user with the fewest in flight.
+# Images queued SCHEDULER_DISPATCH_TIMEOUT seconds ago and still unfinished
+# are assumed lost and are queued again. Celery beat runs the scheduler
+# every SCHEDULER_INTERVAL seconds as a safety net.
+SCHEDULER_MAX_IN_FLIGHT = int(os.getenv('SCHEDULER_MAX_IN_FLIGHT', 100))
+SCHEDULER_USER_MAX_IN_FLIGHT = int(os.getenv('SCHEDULER_USER_MAX_IN_FLIGHT', 50))
+SCHEDULER_DISPATCH_TIMEOUT = int(os.getenv('SCHEDULER_DISPATCH_TIMEOUT', 900))
+SCHEDULER_INTERVAL = float(os.getenv('SCHEDULER_INTERVAL', 30))
+SCHEDULER_LOCK_KEY = int(os.getenv('SCHEDULER_LOCK_KEY', 7146102))
+
+# A task claims its filtered images for LEASE_SECONDS and, while it makes
+# progress, renews the lease every LEASE_RENEW_INTERVAL seconds, so only the
+# longest single filter has to fit in a lease. Images whose lease lapsed
+# (their worker died or hung) are returned to the queue every
+# LEASE_RECLAIM_INTERVAL seconds.
+LEASE_SECONDS = int(os.getenv('LEASE_SECONDS', 900))
+LEASE_RENEW_INTERVAL = float(os.getenv('LEASE_RENEW_INTERVAL', LEASE_SECONDS / 3))
+LEASE_RECLAIM_INTERVAL = float(os.getenv('LEASE_RECLAIM_INTERVAL', 60))
+
+celery_app.conf.beat_schedule = {
+    'schedule-bulk-work': {'task': 'schedule_bulk_work', 'schedule': SCHEDULER_INTERVAL},
+    'reclaim-expired-leases': {'task': 'reclaim_expired_leases', 'schedule': LEASE_RECLAIM_INTERVAL},
+}
+
+# Worker-local caches: Filter and Image rows for a few minutes, and recently
+# downloaded originals up to a size limit. Filter changes are published on
+# CACHE_INVALIDATION_CHANNEL so workers drop stale settings straight away.
+FILTER_CACHE_TTL = float(os.getenv('FILTER_CACHE_TTL', 300))
+IMAGE_CACHE_TTL = float(os.getenv('IMAGE_CACHE_TTL', 300))
+ROW_CACHE_MAX_ENTRIES = int(os.getenv('ROW_CACHE_MAX_ENTRIES', 1024))
+ORIGINAL_CACHE_MB = float(os.getenv('ORIGINAL_CACHE_MB', 64))
+CACHE_INVALIDATION_CHANNEL = os.getenv('CACHE_INVALIDATION_CHANNEL', 'artyfy:cache-invalidation')
+
+# "serial" processes a chunk's originals one after another. "pipelined"
+# overlaps downloads and uploads (on PIPELINE_IO_THREADS threads) with
+# filtering (on PIPELINE_CPU_WORKERS processes), holding at most
+# PIPELINE_PREFETCH downloaded originals that are waiting for a CPU worker
+WORKER_MODE = os.getenv('WORKER_MODE', 'serial')
+PIPELINE_IO_THREADS = int(os.getenv('PIPELINE_IO_THREADS', 8))
+PIPELINE_CPU_WORKERS = int(os.getenv('PIPELINE_CPU_WORKERS', os.cpu_count() or 1))
+PIPELINE_PREFETCH = int(os.getenv('PIPELINE_PREFETCH', 4))
+
+# Cancelling a job sets a Redis flag that workers check before each
+# download, filter and upload; flags expire after CANCEL_FLAG_TTL seconds
+CANCEL_FLAG_PREFIX = os.getenv('CANCEL_FLAG_PREFIX', 'artyfy:cancelled-job:')
+CANCEL_FLAG_TTL = int(os.getenv('CANCEL_FLAG_TTL', 7 * 24 * 3600))
 
 # Import models here to avoid circular imports
-from models import db, ProcessingStatus, FilteredImage, FilterJob, Filter, Image
+from models import db, ProcessingStatus, FilteredImage, FilterJob, Filter, Image, ResultCache
+from sqlalchemy import select, update, func, and_, or_, text
+from sqlalchemy.dialects.postgresql import insert
 from app import app
 
-def upload_to_s3(file_data, file_name):
-    """Upload a file to S3 bucket"""
-    bucket_name = os.getenv('S3_BUCKET_NAME')
+class TTLCache:
+    """Thread-safe LRU mapping whose entries expire ttl seconds after they are stored"""
+    
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+    
+    def put(self, key, value):
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class ByteLRUCache:
+    """Thread-safe LRU of byte strings, bounded by their total size"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+    
+    def put(self, key, value):
+        # Never let one large original flush everything else
+        if len(value) > self.max_bytes // 4:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key))
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+# Detached copies of the rows workers read, safe to keep across sessions
+FilterSnapshot = namedtuple('FilterSnapshot', ['id', 'settings'])
+
+class ImageSnapshot:
+    """The Image columns workers use; hash, size and dimensions are filled in on first download"""
+    __slots__ = ('id', 'original_url', 'storage_bucket', 'storage_key', 'content_hash', 'file_size',
+                 'width', 'height')
+    
+    def __init__(self, image):
+        self.id = image.id
+        self.original_url = image.original_url
+        self.storage_bucket = image.storage_bucket
+        self.storage_key = image.storage_key
+        self.content_hash = image.content_hash
+        self.file_size = image.file_size
+        self.width = image.width
+        self.height = image.height
+
+def _process_alive(pid):
     try:
-        s3_client.put_object(
-            Bucket=bucket_name,
-            Key=file_name,
-            Body=file_data,
-            ContentType='image/jpeg'
-        )
-        return f"{os.getenv('S3_ENDPOINT')}/{bucket_name}/{file_name}"
-    except NoCredentialsError:
-        print("S3 credentials not available")
-        return None
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class MemoryBudget:
+    """
+    Bytes of decoded pixels the processes sharing a file may hold at once
+    
+    Every reservation is a [pid, bytes] entry in a small JSON file, read and
+    written under an exclusive flock, so all worker processes on a host (and
+    the threads within them) count against one budget. Entries of processes
+    that no longer exist, e.g. ones killed for running out of memory, are
+    dropped whenever the file is read, so a crash cannot leak budget. One
+    holder may exceed the limit alone.
+    """
+    
+    def __init__(self, limit, path):
+        self.limit = limit
+        self.path = path
+    
+    @contextmanager
+    def _holders(self):
+        # A fresh file description per call: flock then also excludes other threads
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                holders = [entry for entry in json.loads(f.read() or '[]') if _process_alive(entry[0])]
+            except ValueError:
+                holders = []
+            yield holders
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(holders))
+    
+    def try_acquire(self, amount):
+        with self._holders() as holders:
+            used = sum(held for _, held in holders)
+            if used and used + amount > self.limit:
+                return False
+            holders.append([os.getpid(), amount])
+            return True
+    
+    def acquire(self, amount):
+        while not self.try_acquire(amount):
+            time.sleep(DECODE_BUDGET_POLL)
+        return True
+    
+    def release(self, amount):
+        with self._holders() as holders:
+            if [os.getpid(), amount] in holders:
+                holders.remove([os.getpid(), amount])
+    
+    @contextmanager
+    def reserve(self, amount):
+        self.acquire(amount)
+        try:
+            yield
+        finally:
+            self.release(amount)
+
+filter_cache = TTLCache(FILTER_CACHE_TTL, ROW_CACHE_MAX_ENTRIES)
+image_cache = TTLCache(IMAGE_CACHE_TTL, ROW_CACHE_MAX_ENTRIES)
+original_cache = ByteLRUCache(int(ORIGINAL_CACHE_MB * 1024 * 1024))
+decode_budget = MemoryBudget(int(DECODE_MEMORY_MB * 1024 * 1024), DECODE_BUDGET_FILE)
+
+_redis = None
+_redis_pid = None
+_listener_pid = None
+
+def get_redis():
+    """Return this process's Redis client"""
+    global _redis, _redis_pid
+    if _redis is None or _redis_pid != os.getpid():
+        _redis = redis.Redis.from_url(os.getenv('REDIS_URL', celery_app.conf.broker_url))
+        _redis_pid = os.getpid()
+    return _redis
+
+def publish_invalidation(kind, key):
+    """Tell every worker to drop a cached row, e.g. ("filter", filter_id)"""
+    try:
+        get_redis().publish(CACHE_INVALIDATION_CHANNEL, f"{kind}:{key}")
     except Exception as e:
-        print(f"Error uploading to S3: {str(e)}")
-        return None
+        print(f"Error publishing cache invalidation: {str(e)}")
 
-def download_from_s3(file_url):
-    """Download a file from S3 bucket"""
-    bucket_name = os.getenv('S3_BUCKET_NAME')
-    if not file_url:
-        return None
+def _listen_for_invalidations():
+    """Drop cached rows as invalidations arrive; runs on a daemon thread per process"""
+    while True:
+        try:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+            for message in pubsub.listen():
+                kind, _, key = message['data'].decode().partition(':')
+                if kind == 'filter':
+                    filter_cache.pop(uuid.UUID(key))
+                elif kind == 'image':
+                    image_cache.pop(uuid.UUID(key))
+        except Exception as e:
+            print(f"Cache invalidation listener error: {str(e)}")
+        # Messages may have been missed while disconnected
+        filter_cache.clear()
+        image_cache.clear()
+        time.sleep(5)
+
+def ensure_invalidation_listener():
+    """Start this process's invalidation listener if it is not running yet"""
+    global _listener_pid
+    if _listener_pid == os.getpid() or FILTER_CACHE_TTL <= 0:
+        return
+    _listener_pid = os.getpid()
+    threading.Thread(target=_listen_for_invalidations, name='cache-invalidation', daemon=True).start()
+
+def get_filters(filter_ids):
+    """Return {id: FilterSnapshot} for these filters, querying only those not cached"""
+    ensure_invalidation_listener()
+    found = {}
+    for filter_id in filter_ids:
+        snapshot = filter_cache.get(filter_id)
+        if snapshot:
+            found[filter_id] = snapshot
+    missing = [filter_id for filter_id in filter_ids if filter_id not in found]
+    if missing:
+        for f in Filter.query.filter(Filter.id.in_(missing)).all():
+            found[f.id] = FilterSnapshot(f.id, f.settings)
+            filter_cache.put(f.id, found[f.id])
+    return found
+
+def get_images(image_ids):
+    """Return {id: ImageSnapshot} for these originals, querying only those not cached"""
+    found = {}
+    for image_id in image_ids:
+        snapshot = image_cache.get(image_id)
+        if snapshot:
+            found[image_id] = snapshot
+    missing = [image_id for image_id in image_ids if image_id not in found]
+    if missing:
+        for img in Image.query.filter(Image.id.in_(missing)).all():
+            found[img.id] = ImageSnapshot(img)
+            image_cache.put(img.id, found[img.id])
+    return found
+
+def fetch_original(original_image):
+    """
+    Return an original's bytes, downloading them only if this worker has not recently
     
+    Originals too large for storage.S3_SPOOL_MB are returned as a seekable
+    temporary file on disk instead, which the decoder reads as it goes.
+    They are not cached.
+    """
+    image_data = original_cache.get(original_image.original_url)
+    metrics.inc('original_cache_requests_total', result='miss' if image_data is None else 'hit')
+    if image_data is None:
+        source = storage.open_file(original_image.original_url, original_image.storage_bucket,
+                                   original_image.storage_key)
+        if source is None:
+            return None
+        if source.seek(0, io.SEEK_END) > storage.S3_SPOOL_MB * storage.MB:
+            source.seek(0)
+            return source
+        source.seek(0)
+        with source:
+            image_data = source.read()
+        if image_data:
+            original_cache.put(original_image.original_url, image_data)
+    return image_data
+
+def original_bytes(image_data):
+    """Read an original returned by fetch_original fully into memory"""
+    if hasattr(image_data, 'read'):
+        image_data.seek(0)
+        return image_data.read()
+    return image_data
+
+_cancelled_jobs = set()
+
+def flag_job_cancelled(job_id):
+    """Tell workers to drop the remaining work of a cancelled job"""
     try:
-        # Extract file name from URL
-        file_name = file_url.split('/')[-1]
-        response = s3_client.get_object(Bucket=bucket_name, Key=file_name)
-        return response['Body'].read()
+        get_redis().set(f"{CANCEL_FLAG_PREFIX}{job_id}", 1, ex=CANCEL_FLAG_TTL)
+        return True
     except Exception as e:
-        print(f"Error downloading from S3: {str(e)}")
+        print(f"Error flagging job {job_id} cancelled: {str(e)}")
+        return False
+
+def cancelled_jobs(job_ids):
+    """Return the ids among these jobs that have been cancelled, with one Redis round trip"""
+    job_ids = {job_id for job_id in job_ids if job_id}
+    # A job never comes back from cancelled, so known ones need no lookup
+    found = job_ids & _cancelled_jobs
+    unknown = list(job_ids - found)
+    if unknown:
+        try:
+            flags = get_redis().mget([f"{CANCEL_FLAG_PREFIX}{job_id}" for job_id in unknown])
+        except Exception as e:
+            # Keep working; the job row still says CANCELLED
+            print(f"Error checking for cancelled jobs: {str(e)}")
+            return found
+        found.update(job_id for job_id, flag in zip(unknown, flags) if flag)
+        _cancelled_jobs.update(found)
+    return found
+
+def drop_cancelled(pending):
+    """Mark the entries of cancelled jobs cancelled; returns the rest"""
+    cancelled = cancelled_jobs(entry[0].filter_job_id for entry in pending)
+    if not cancelled:
+        return pending
+    remaining = []
+    for entry in pending:
+        if entry[0].filter_job_id in cancelled:
+            mark_cancelled(entry[0])
+        else:
+            remaining.append(entry)
+    return remaining
+
+def admission(original_image, large=False):
+    """
+    Decide what a worker may do with an original of known dimensions
+    
+    Returns "ok", "too_large" (over filters.MAX_IMAGE_PIXELS) or "large"
+    when it is over LARGE_IMAGE_PIXELS and large is False. Originals not
+    downloaded yet are "ok" until their header has been read.
+    """
+    if not original_image.width or not original_image.height:
+        return 'ok'
+    pixels = original_image.width * original_image.height
+    if pixels > filters.MAX_IMAGE_PIXELS:
+        return 'too_large'
+    if pixels > LARGE_IMAGE_PIXELS and not large:
+        return 'large'
+    return 'ok'
+
+def inspect_original(original_image, image_data):
+    """Read an original's header, storing its dimensions the first time; returns filters.ImageInfo"""
+    info = filters.inspect_image(image_data)
+    if original_image.width is None:
+        original_image.width, original_image.height = info.width, info.height
+        db.session.execute(
+            update(Image)
+            .where(Image.id == original_image.id)
+            .values(width=info.width, height=info.height)
+        )
+    return info
+
+def is_large(width, height):
+    """Return True if an original of these dimensions belongs on LARGE_QUEUE"""
+    return bool(width and height and width * height > LARGE_IMAGE_PIXELS)
+
+def claim(filtered_image_ids):
+    """
+    Lease filtered images to the calling task
+    
+    Only pending images, and processing ones whose lease has lapsed, are
+    claimed; the conditional UPDATE makes a duplicate delivery of the same
+    images claim nothing.
+    
+    Returns (lease owner, ids of the claimed images)
+    """
+    lease_owner = uuid.uuid4().hex
+    now = datetime.utcnow()
+    claimed = db.session.execute(
+        update(FilteredImage)
+        .where(FilteredImage.id.in_([uuid.UUID(str(fid)) for fid in filtered_image_ids]),
+               or_(FilteredImage.status == ProcessingStatus.PENDING,
+                   and_(FilteredImage.status == ProcessingStatus.PROCESSING,
+                        FilteredImage.lease_expires_at < now)))
+        .values(status=ProcessingStatus.PROCESSING, lease_owner=lease_owner,
+                lease_expires_at=now + timedelta(seconds=LEASE_SECONDS))
+        .returning(FilteredImage.id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    commit()
+    return lease_owner, claimed
+
+class LeaseRenewal:
+    """
+    Keeps a task's lease on its filtered images from lapsing while it works
+    
+    renew() is called as the task makes progress. At most every
+    LEASE_RENEW_INTERVAL seconds, it moves lease_expires_at LEASE_SECONDS
+    ahead for the images the task still holds. The UPDATE runs and commits on
+    its own connection, so the task's unflushed results are left alone. A
+    task that stops making progress stops renewing, and its images are
+    reclaimed as before.
+    """
+    
+    def __init__(self, filtered_image_ids, lease_owner):
+        self.ids = [uuid.UUID(str(fid)) for fid in filtered_image_ids]
+        self.lease_owner = lease_owner
+        self.renewed_at = time.monotonic()
+    
+    def renew(self):
+        if time.monotonic() - self.renewed_at < LEASE_RENEW_INTERVAL:
+            return
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    update(FilteredImage)
+                    .where(FilteredImage.id.in_(self.ids), FilteredImage.lease_owner == self.lease_owner,
+                           FilteredImage.status == ProcessingStatus.PROCESSING)
+                    .values(lease_expires_at=datetime.utcnow() + timedelta(seconds=LEASE_SECONDS))
+                )
+            self.renewed_at = time.monotonic()
+        except Exception as e:
+            print(f"Failed to renew lease {self.lease_owner}: {str(e)}")
+
+def keep_leased(filtered_images, lease_owner):
+    """
+    Lock the images this task still holds and discard its changes to the rest
+    
+    An image whose lease lapsed may have been reclaimed by another worker,
+    whose result then stands. Call just before the final commit, with the
+    task's changes to the images not flushed yet.
+    
+    Returns the images still held
+    """
+    with db.session.no_autoflush:
+        held = set(db.session.execute(
+            select(FilteredImage.id)
+            .where(FilteredImage.id.in_([fi.id for fi in filtered_images]),
+                   FilteredImage.lease_owner == lease_owner)
+            .with_for_update()
+        ).scalars())
+    for fi in filtered_images:
+        if fi.id not in held:
+            print(f"Lease on filtered image {fi.id} was lost; discarding this result")
+            db.session.expire(fi)
+    return [fi for fi in filtered_images if fi.id in held]
+
+def queue_for_job(image_count):
+    """Return the queue for a job: interactive for small jobs, bulk otherwise"""
+    return INTERACTIVE_QUEUE if image_count <= INTERACTIVE_MAX_IMAGES else BULK_QUEUE
+
+def record_job_progress(job_id, completed=0, failed=0):
+    """
+    Atomically add to a job's counters and finish it once every image is done
+    
+    The counters are bumped with a single UPDATE ... RETURNING, so concurrent
+    workers never lose each other's updates. Only the update that brings the
+    total up to image_count moves the job to COMPLETED (or FAILED if no
+    image succeeded), and only while the job is still unfinished.
+    
+    Returns True if this call finished the job
+    """
+    if not job_id or not (completed or failed):
+        return False
+    row = db.session.execute(
+        update(FilterJob)
+        .where(FilterJob.id == job_id)
+        .values(completed_count=FilterJob.completed_count + completed,
+                failed_count=FilterJob.failed_count + failed)
+        .returning(FilterJob.completed_count, FilterJob.failed_count, FilterJob.image_count)
+    ).first()
+    if not row or row.completed_count + row.failed_count < row.image_count:
+        return False
+    final_status = ProcessingStatus.COMPLETED if row.completed_count else ProcessingStatus.FAILED
+    result = db.session.execute(
+        update(FilterJob)
+        .where(FilterJob.id == job_id,
+               FilterJob.status.notin_([ProcessingStatus.COMPLETED, ProcessingStatus.FAILED,
+                                        ProcessingStatus.CANCELLED]))
+        .values(status=final_status)
+    )
+    return result.rowcount == 1
+
+def record_outcomes(filtered_images):
+    """Add the completed and failed images among these to their jobs' counters"""
+    tally = {}
+    for fi in filtered_images:
+        if fi.status in (ProcessingStatus.COMPLETED, ProcessingStatus.FAILED):
+            counts = tally.setdefault(fi.filter_job_id, [0, 0])
+            counts[fi.status == ProcessingStatus.FAILED] += 1
+    # Lock job rows in a fixed order so concurrent chunks cannot deadlock
+    for job_id in sorted(tally, key=str):
+        record_job_progress(job_id, *tally[job_id])
+    return tally
+
+def upload_renditions(renditions, base_name):
+    """Upload encoded renditions; returns their URLs keyed by size"""
+    urls = {}
+    for size, rendition in (renditions or {}).items():
+        stored = storage.upload_file(rendition.data, f"{base_name}_{size}.{rendition.extension}",
+                                     rendition.content_type)
+        if stored:
+            urls[size] = stored.url
+    return urls or None
+
+def mark_failed(filtered_image, reason):
+    """Mark a filtered image failed, counting it under reason"""
+    filtered_image.status = ProcessingStatus.FAILED
+    metrics.inc('images_failed_total', reason=reason)
+
+def mark_cancelled(filtered_image):
+    """Mark a filtered image of a cancelled job cancelled"""
+    filtered_image.status = ProcessingStatus.CANCELLED
+    metrics.inc('images_cancelled_total')
+
+def mark_deferred(filtered_image):
+    """Release a filtered image to be processed on LARGE_QUEUE"""
+    filtered_image.status = ProcessingStatus.PENDING
+    filtered_image.lease_owner = None
+    filtered_image.lease_expires_at = None
+    if filtered_image.dispatched_at:
+        filtered_image.dispatched_at = datetime.utcnow()
+
+def mark_completed(filtered_image, result, renditions, source='rendered'):
+    """Record a filtered image's result (a storage.StoredFile) and mark it completed"""
+    filtered_image.result_url, filtered_image.storage_bucket, filtered_image.storage_key = result
+    filtered_image.renditions = renditions
+    filtered_image.status = ProcessingStatus.COMPLETED
+    metrics.inc('images_completed_total', source=source)
+
+def commit():
+    """Commit the session, timing it"""
+    with metrics.timer('stage_duration_seconds', stage='db_commit'):
+        db.session.commit()
+
+def complete_from_cache(filtered_image, cache_key):
+    """Link a cached result to a filtered image; returns False on a cache miss"""
+    if not RESULT_CACHE_ENABLED or not cache_key:
+        return False
+    entry = ResultCache.query.get(cache_key)
+    if not entry:
+        return False
+    result = storage.StoredFile(entry.result_url, entry.storage_bucket, entry.storage_key)
+    mark_completed(filtered_image, result, entry.renditions, source='cached')
+    return True
+
+def remember_result(cache_key, result, content_type, renditions=None):
+    """Record an uploaded result (a storage.StoredFile) for reuse; the first writer wins"""
+    if not RESULT_CACHE_ENABLED:
+        return
+    db.session.execute(
+        insert(ResultCache)
+        .values(cache_key=cache_key, result_url=result.url, storage_bucket=result.bucket,
+                storage_key=result.key, content_type=content_type, renditions=renditions)
+        .on_conflict_do_nothing(index_elements=['cache_key'])
+    )
+
+def record_original(original_image, image_data):
+    """Store the SHA-256 and size of an original the first time it is downloaded"""
+    if not original_image.content_hash:
+        if hasattr(image_data, 'read'):
+            image_data.seek(0)
+            original_image.content_hash = hashlib.file_digest(image_data, 'sha256').hexdigest()
+            original_image.file_size = image_data.tell()
+        else:
+            original_image.content_hash = hashlib.sha256(image_data).hexdigest()
+            original_image.file_size = len(image_data)
+        db.session.execute(
+            update(Image)
+            .where(Image.id == original_image.id)
+            .values(content_hash=original_image.content_hash, file_size=original_image.file_size)
+        )
+    return original_image.content_hash
+
+def cache_key_for(content_hash, filter_obj, max_dimension, output_options):
+    """Return the result cache key, or None if the original's content is unknown"""
+    if not content_hash:
         return None
+    return filters.result_cache_key(content_hash, filter_obj.settings, max_dimension, output_options)
+
+@celery_app.task(name='process_image')
+def process_image(filtered_image_id):
+    """
+    Process a single image with the specified filter
+    
+    Kept for messages queued by older releases; the image is processed as a
+    chunk of one by process_image_batch.
+    """
+    return process_image_batch(filtered_image_ids=[filtered_image_id])
+
+def split_cached(pending, content_hash):
+    """Complete the cached entries of a group; returns the rest"""
+    remaining = []
+    for entry in pending:
+        fi, filter_obj, max_dimension, output_options = entry
+        cache_key = cache_key_for(content_hash, filter_obj, max_dimension, output_options)
+        if not complete_from_cache(fi, cache_key):
+            remaining.append(entry)
+    return remaining
+
+def upload_result(processed, result_name):
+    """Upload an encoded result and its renditions; returns (StoredFile or None, content type, rendition URLs)"""
+    result = storage.upload_file(processed.data, f"{result_name}.{processed.extension}", processed.content_type)
+    if not result:
+        return None, processed.content_type, None
+    return result, processed.content_type, upload_renditions(processed.renditions, result_name)
+
+def resolve_entries(filtered_images, originals, filter_objs, job_options):
+    """
+    Pair filtered images with their filter and output options
+    
+    Records whose original or filter is missing, or whose options are
+    invalid, are marked failed and left out.
+    
+    Returns a list of (filtered image, filter, max dimension, output options)
+    """
+    entries = []
+    for fi in filtered_images:
+        filter_obj = filter_objs.get(fi.filter_id)
+        if fi.image_id not in originals or not filter_obj:
+            print(f"Original image or filter not found for {fi.id}")
+            mark_failed(fi, 'not_found')
+            continue
+        options = job_options.get(fi.filter_job_id)
+        try:
+            max_dimension = filters.resolve_max_dimension(filter_obj.settings, options)
+            output_options = encoders.resolve_output_options(filter_obj.settings, options)
+        except ValueError as e:
+            print(f"Invalid options for {fi.id}: {str(e)}")
+            mark_failed(fi, 'invalid_options')
+            continue
+        entries.append((fi, filter_obj, max_dimension, output_options))
+    return entries
 
-def apply_filter(image_data, filter_settings):
-    """Apply filter effects to an image based on settings"""
+def prefetch_related(filtered_images):
+    """Load the originals, filters and job options of filtered images, one query each for those not cached"""
+    with metrics.timer('stage_duration_seconds', stage='db_fetch'):
+        return _prefetch_related(filtered_images)
+
+def _prefetch_related(filtered_images):
+    image_ids = {fi.image_id for fi in filtered_images}
+    filter_ids = {fi.filter_id for fi in filtered_images}
+    job_ids = {fi.filter_job_id for fi in filtered_images if fi.filter_job_id}
+    originals = get_images(image_ids)
+    filter_objs = get_filters(filter_ids)
+    job_options = {}
+    if job_ids:
+        rows = db.session.query(FilterJob.id, FilterJob.options).filter(FilterJob.id.in_(job_ids))
+        job_options = {job_id: options for job_id, options in rows}
+    return originals, filter_objs, job_options
+
+def admit(original_image, pending, large, deferred):
+    """
+    Apply admission control to the pending entries of an original
+    
+    Entries of an original that is too large are marked failed. Entries
+    of an original that belongs on LARGE_QUEUE are released and added to
+    deferred. Returns True if the entries may be processed here.
+    """
+    verdict = admission(original_image, large)
+    if verdict == 'too_large':
+        print(f"Image {original_image.id} has more than {filters.MAX_IMAGE_PIXELS} pixels")
+        for fi, _, _, _ in pending:
+            mark_failed(fi, 'too_large')
+        return False
+    if verdict == 'large':
+        for fi, _, _, _ in pending:
+            mark_deferred(fi)
+            deferred.append(fi)
+        return False
+    return True
+
+def process_original(original_image, pending, large=False, lease=None):
+    """
+    Render several filters over one original, downloading and decoding it once
+    
+    Updates each filtered image's status and result but does not commit or
+    touch job counters.
+    
+    Args:
+        original_image (Image): The shared original
+        pending (list): Entries as returned by resolve_entries
+        large (bool): Whether this worker takes originals over LARGE_IMAGE_PIXELS
+        lease (LeaseRenewal, optional): Renewed after each filter
+    
+    Returns:
+        list: Filtered images released for LARGE_QUEUE
+    """
+    deferred = []
+    
+    # Reuse identical earlier results without downloading anything
+    pending = split_cached(pending, original_image.content_hash)
+    if not pending:
+        return deferred
+    
+    def fail_pending(reason):
+        for fi, _, _, _ in pending:
+            mark_failed(fi, reason)
+    
+    # Drop the work of cancelled jobs before each expensive stage
+    pending = drop_cancelled(pending)
+    if not pending or not admit(original_image, pending, large, deferred):
+        return deferred
+    
+    # Download original image from storage once, unless this worker has it
+    image_data = fetch_original(original_image)
     if not image_data:
-        return None
+        print(f"Failed to download image from {original_image.original_url}")
+        fail_pending('download')
+        return deferred
     
+    # Check the header before decoding anything
     try:
-        # Open image
-        img = PILImage.open(io.BytesIO(image_data))
-        
-        # Apply filter based on settings
-        filter_type = filter_settings.get('type', '')
-        
-        if filter_type == 'grayscale':
-            img = ImageOps.grayscale(img)
-            # Convert back to RGB for consistent saving
-            img = PILImage.merge('RGB', [img, img, img])
-        
-        elif filter_type == 'sepia':
-            sepia_filter = lambda x: tuple(
-                int(min(255, x[0] * 0.393 + x[1] * 0.769 + x[2] * 0.189)),
-                int(min(255, x[0] * 0.349 + x[1] * 0.686 + x[2] * 0.168)),
-                int(min(255, x[0] * 0.272 + x[1] * 0.534 + x[2] * 0.131))
-            )
-            img = img.convert('RGB')
-            pixels = img.load()
-            width, height = img.size
-            for x in range(width):
-                for y in range(height):
-                    pixels[x, y] = sepia_filter(pixels[x, y])
-        
-        elif filter_type == 'contrast':
-            contrast_value = filter_settings.get('value', 1.5)
-            enhancer = ImageEnhance.Contrast(img)
-            img = enhancer.enhance(contrast_value)
-        
-        elif filter_type == 'brightness':
-            brightness_value = filter_settings.get('value', 1.2)
-            enhancer = ImageEnhance.Brightness(img)
-            img = enhancer.enhance(brightness_value)
+        info = inspect_original(original_image, image_data)
+    except Exception as e:
+        print(f"Failed to read image {original_image.id}: {str(e)}")
+        fail_pending('decode')
+        return deferred
+    if not admit(original_image, pending, large, deferred):
+        return deferred
+    
+    # First download of this original: its content may match another upload
+    if not original_image.content_hash:
+        content_hash = record_original(original_image, image_data)
+        pending = split_cached(pending, content_hash)
+        if not pending:
+            return deferred
+    
+    pending = drop_cancelled(pending)
+    if not pending:
+        return deferred
+    
+    uploads = {}
+    # Wait for room in the host's decode budget
+    with decode_budget.reserve(filters.decoded_size(info)):
+        # Decode once, large enough for the biggest requested output
+        limits = [max_dimension for _, _, max_dimension, _ in pending]
+        decode_dimension = None if None in limits else max(limits)
+        try:
+            decoded = filters.decode_image(image_data, decode_dimension)
+            decoded.load()
+        except Exception as e:
+            print(f"Failed to decode image {original_image.id}: {str(e)}")
+            fail_pending('decode')
+            return deferred
+        del image_data
         
-        elif filter_type == 'blur':
-            blur_radius = filter_settings.get('radius', 2)
-            img = img.filter(ImageFilter.GaussianBlur(radius=blur_radius))
+        # Filter each result from the shared decoded image and upload it
+        # in the background while the next filter runs
+        with ThreadPoolExecutor(max_workers=GROUP_UPLOAD_CONCURRENCY) as pool:
+            for index, (fi, filter_obj, max_dimension, output_options) in enumerate(pending):
+                try:
+                    # Plans may work in place, so copy the decoded image
+                    # while a later filter still needs it
+                    img = filters.fit_image(decoded, max_dimension)
+                    if img is decoded and index < len(pending) - 1:
+                        img = decoded.copy()
+                    processed = filters.render(img, filter_obj.settings, output_options,
+                                               filters.RENDITION_SIZES)
+                except Exception as e:
+                    print(f"Failed to apply filter to image {fi.id}: {str(e)}")
+                    mark_failed(fi, 'filter')
+                    continue
+                if lease:
+                    lease.renew()
+                if cancelled_jobs([fi.filter_job_id]):
+                    mark_cancelled(fi)
+                    continue
+                uploads[fi.id] = pool.submit(upload_result, processed, f"filtered_{fi.id}")
+        del decoded
+    
+    # Update filtered image records
+    for fi, filter_obj, max_dimension, output_options in pending:
+        if fi.id not in uploads:
+            continue
+        result, content_type, rendition_urls = uploads[fi.id].result()
+        if not result:
+            print(f"Failed to upload processed image {fi.id}")
+            mark_failed(fi, 'upload')
+            continue
+        mark_completed(fi, result, rendition_urls)
+        cache_key = cache_key_for(original_image.content_hash, filter_obj, max_dimension, output_options)
+        remember_result(cache_key, result, content_type, rendition_urls)
+    return deferred
+
+_pipeline_pools = None
+_pipeline_pools_pid = None
+
+def get_pipeline_pools():
+    """
+    Return this process's (I/O pool, CPU pool) for pipelined mode
+    
+    Pools are created on first use and again after a fork. Prefork pool
+    children are daemonic and may not start processes of their own, so
+    there the CPU stage uses threads; most Pillow filter and codec work
+    releases the GIL. Run the worker with --pool=solo or --pool=threads to
+    get a process pool.
+    """
+    global _pipeline_pools, _pipeline_pools_pid
+    if _pipeline_pools is None or _pipeline_pools_pid != os.getpid():
+        io_pool = ThreadPoolExecutor(max_workers=PIPELINE_IO_THREADS)
+        if multiprocessing.current_process().daemon:
+            cpu_pool = ThreadPoolExecutor(max_workers=PIPELINE_CPU_WORKERS)
+        else:
+            # Spawned workers import only filters, not the app or its connections
+            cpu_pool = ProcessPoolExecutor(max_workers=PIPELINE_CPU_WORKERS,
+                                           mp_context=multiprocessing.get_context('spawn'))
+        _pipeline_pools = (io_pool, cpu_pool)
+        _pipeline_pools_pid = os.getpid()
+    return _pipeline_pools
+
+def replace_cpu_pool():
+    """Swap a broken CPU pool (a worker process died) for a fresh one"""
+    global _pipeline_pools
+    io_pool, cpu_pool = get_pipeline_pools()
+    cpu_pool.shutdown(wait=False)
+    _pipeline_pools = (io_pool, ProcessPoolExecutor(max_workers=PIPELINE_CPU_WORKERS,
+                                                    mp_context=multiprocessing.get_context('spawn')))
+    return _pipeline_pools[1]
+
+def process_originals_pipelined(work, large=False, lease=None):
+    """
+    Process several originals with their download, filter and upload stages overlapped
+    
+    Worker threads and processes only move bytes and pixels; every database
+    change happens on the calling thread as stages finish. Each stage is
+    bounded: downloads stop while PIPELINE_PREFETCH originals wait for a CPU
+    worker, rendering stops while a full round of uploads is queued, and
+    originals are only sent for decoding while they fit in decode_budget.
+    
+    Like process_original, this updates filtered images but does not commit
+    or touch job counters.
+    
+    Args:
+        work (list): (original image, pending entries) pairs
+        large (bool): Whether this worker takes originals over LARGE_IMAGE_PIXELS
+        lease (LeaseRenewal, optional): Renewed as stages finish
+    
+    Returns:
+        list: Filtered images released for LARGE_QUEUE
+    """
+    io_pool, cpu_pool = get_pipeline_pools()
+    queued = deque(work)
+    downloaded = deque()
+    downloads, renders, uploads = {}, {}, {}
+    broken_by = set()
+    deferred = []
+    
+    def fail(pending, reason):
+        for fi, _, _, _ in pending:
+            mark_failed(fi, reason)
+    
+    def on_downloaded(original_image, pending, image_data):
+        if not image_data:
+            print(f"Failed to download image from {original_image.original_url}")
+            fail(pending, 'download')
+            return
+        # Check the header before anything is decoded
+        try:
+            info = inspect_original(original_image, image_data)
+        except Exception as e:
+            print(f"Failed to read image {original_image.id}: {str(e)}")
+            fail(pending, 'decode')
+            return
+        if not admit(original_image, pending, large, deferred):
+            return
+        # First download of this original: its content may match another upload
+        if not original_image.content_hash:
+            pending = split_cached(pending, record_original(original_image, image_data))
+        if pending:
+            downloaded.append((original_image, pending, image_data, filters.decoded_size(info)))
+    
+    def on_rendered(original_image, pending, results):
+        cancelled = cancelled_jobs(entry[0].filter_job_id for entry in pending)
+        for entry, processed in zip(pending, results):
+            fi = entry[0]
+            if isinstance(processed, Exception):
+                print(f"Failed to apply filter to image {fi.id}: {str(processed)}")
+                mark_failed(fi, 'filter')
+                continue
+            if fi.filter_job_id in cancelled:
+                mark_cancelled(fi)
+                continue
+            uploads[io_pool.submit(upload_result, processed, f"filtered_{fi.id}")] = (original_image, entry)
+    
+    def on_uploaded(original_image, entry, outcome):
+        fi, filter_obj, max_dimension, output_options = entry
+        result, content_type, rendition_urls = outcome
+        if not result:
+            print(f"Failed to upload processed image {fi.id}")
+            mark_failed(fi, 'upload')
+            return
+        mark_completed(fi, result, rendition_urls)
+        cache_key = cache_key_for(original_image.content_hash, filter_obj, max_dimension, output_options)
+        remember_result(cache_key, result, content_type, rendition_urls)
+    
+    # Reuse identical earlier results without downloading anything
+    for original_image, pending in work:
+        pending[:] = split_cached(pending, original_image.content_hash)
+    
+    try:
+        while queued or downloaded or downloads or renders or uploads:
+            # Prefetch originals while there is room for them
+            while queued and len(downloads) + len(downloaded) < PIPELINE_PREFETCH:
+                original_image, pending = queued.popleft()
+                pending = drop_cancelled(pending)
+                if pending and admit(original_image, pending, large, deferred):
+                    future = io_pool.submit(fetch_original, original_image)
+                    downloads[future] = (original_image, pending)
         
-        elif filter_type == 'sharpen':
-            img = img.filter(ImageFilter.SHARPEN)
+            # Keep every CPU worker busy unless uploads are falling behind or
+            # the decode budget is spent (with no render of ours running, wait
+            # for other workers on this host to release it)
+            while downloaded and len(renders) < PIPELINE_CPU_WORKERS and len(uploads) < PIPELINE_IO_THREADS:
+                size = downloaded[0][3]
+                if not (decode_budget.try_acquire(size) if renders else decode_budget.acquire(size)):
+                    break
+                original_image, pending, image_data, size = downloaded.popleft()
+                try:
+                    pending = drop_cancelled(pending)
+                    if not pending:
+                        decode_budget.release(size)
+                        continue
+                    specs = [(filter_obj.settings, max_dimension, output_options)
+                             for _, filter_obj, max_dimension, output_options in pending]
+                    if isinstance(cpu_pool, ProcessPoolExecutor):
+                        # Files cannot be sent to another process
+                        image_data = original_bytes(image_data)
+                    future = cpu_pool.submit(filters.render_original, image_data, specs, filters.RENDITION_SIZES)
+                except BaseException:
+                    decode_budget.release(size)
+                    raise
+                renders[future] = (original_image, pending, size)
+                del image_data
         
-        elif filter_type == 'vintage':
-            # Apply a combination of effects for vintage look
-            # First, slightly desaturate
-            enhancer = ImageEnhance.Color(img)
-            img = enhancer.enhance(0.8)
+            if not (downloads or renders or uploads):
+                continue
+            done, _ = wait(list(downloads) + list(renders) + list(uploads), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in downloads:
+                    original_image, pending = downloads.pop(future)
+                    on_downloaded(original_image, pending, future.result())
+                elif future in renders:
+                    original_image, pending, size = renders.pop(future)
+                    decode_budget.release(size)
+                    try:
+                        results = future.result()
+                    except BrokenProcessPool as e:
+                        print(f"Filter worker died while processing image {original_image.id}: {str(e)}")
+                        fail(pending, 'worker_died')
+                        if future in broken_by:
+                            continue
+                        # Every render still on the old pool fails the same way
+                        broken_by.update(renders)
+                        cpu_pool = replace_cpu_pool()
+                        continue
+                    except Exception as e:
+                        print(f"Failed to decode image {original_image.id}: {str(e)}")
+                        fail(pending, 'decode')
+                        continue
+                    on_rendered(original_image, pending, results)
+                else:
+                    original_image, entry = uploads.pop(future)
+                    on_uploaded(original_image, entry, future.result())
+            if lease:
+                lease.renew()
+    finally:
+        # A stage that raised leaves renders behind; their budget is shared
+        # with every worker on the host, so give it back
+        for _, _, size in renders.values():
+            decode_budget.release(size)
+    return deferred
+
+def fail_unfinished(filtered_image_ids, lease_owner):
+    """Mark any of these filtered images this task still holds as failed and count them"""
+    db.session.rollback()
+    ids = [uuid.UUID(fid) for fid in filtered_image_ids]
+    job_ids = db.session.execute(
+        update(FilteredImage)
+        .where(FilteredImage.id.in_(ids), FilteredImage.status == ProcessingStatus.PROCESSING,
+               FilteredImage.lease_owner == lease_owner)
+        .values(status=ProcessingStatus.FAILED)
+        .returning(FilteredImage.filter_job_id)
+    ).scalars().all()
+    metrics.inc('images_failed_total', len(job_ids), reason='error')
+    failed_by_job = {}
+    for job_id in job_ids:
+        failed_by_job[job_id] = failed_by_job.get(job_id, 0) + 1
+    for job_id in sorted(failed_by_job, key=str):
+        record_job_progress(job_id, failed=failed_by_job[job_id])
+    commit()
+
+@celery_app.task(name='process_image_group')
+def process_image_group(filtered_image_ids):
+    """
+    Process several filters over the same original, downloading and decoding it once
+    
+    Kept for messages queued by older releases; process_image_batch already
+    shares each original between its filters.
+    """
+    return process_image_batch(filtered_image_ids)
+
+@celery_app.task(name='process_image_batch')
+def process_image_batch(filtered_image_ids, job_id=None, large=False):
+    """
+    Process a chunk of filtered images in one task
+    
+    Rows are loaded with one query per table and status changes are written
+    in bulk: one UPDATE to mark the chunk processing and one commit for the
+    results. Originals shared by several filters are downloaded once.
+    
+    A chunk of a cancelled job (job_id is the job the chunk was queued for)
+    is dropped before it touches the database or storage. Unless large is
+    set (chunks on LARGE_QUEUE), images of originals over LARGE_IMAGE_PIXELS
+    are passed on to LARGE_QUEUE without being decoded.
+    """
+    if job_id and cancelled_jobs([job_id]):
+        print(f"Skipping chunk of cancelled job {job_id}")
+        return False
+    with app.app_context():
+        lease_owner = None
+        scheduled = False
+        try:
+            # Claim the whole chunk in one statement; a duplicate delivery,
+            # or a chunk whose images were cancelled, claims nothing
+            lease_owner, claimed = claim(filtered_image_ids)
+            if not claimed:
+                print(f"Filtered images {filtered_image_ids} not found or already claimed")
+                return False
             
-            # Add slight sepia tone
-            sepia_filter = lambda x: tuple(
-                int(min(255, x[0] * 0.393 + x[1] * 0.769 + x[2] * 0.189)),
-                int(min(255, x[0] * 0.349 + x[1] * 0.686 + x[2] * 0.168)),
-                int(min(255, x[0] * 0.272 + x[1] * 0.534 + x[2] * 0.131))
-            )
-            img = img.convert('RGB')
-            pixels = img.load()
-            width, height = img.size
-            for x in range(width):
-                for y in range(height):
-                    r, g, b = pixels[x, y]
-                    pixels[x, y] = (
-                        min(255, int(r * 0.9)),
-                        min(255, int(g * 0.9)),
-                        min(255, int(b * 0.7))
+            filtered_images = FilteredImage.query.filter(FilteredImage.id.in_(claimed)).all()
+            scheduled = any(fi.dispatched_at for fi in filtered_images)
+            lease = LeaseRenewal(claimed, lease_owner)
+            
+            # Results stay unflushed until keep_leased has checked the leases
+            with db.session.no_autoflush:
+                # Prefetch originals, filters and options for the whole chunk
+                originals, filter_objs, job_options = prefetch_related(filtered_images)
+                by_original = {}
+                for entry in resolve_entries(filtered_images, originals, filter_objs, job_options):
+                    by_original.setdefault(entry[0].image_id, []).append(entry)
+            
+                if WORKER_MODE == 'pipelined':
+                    # Overlap the chunk's downloads, filtering and uploads
+                    deferred = process_originals_pipelined(
+                        [(originals[image_id], pending) for image_id, pending in by_original.items()], large,
+                        lease
                     )
+                else:
+                    # Process one original at a time; a failure only affects its own images
+                    deferred = []
+                    for image_id, pending in by_original.items():
+                        try:
+                            deferred.extend(process_original(originals[image_id], pending, large, lease))
+                        except Exception as e:
+                            print(f"Error processing image {image_id}: {str(e)}")
+                            for fi, _, _, _ in pending:
+                                if fi.status == ProcessingStatus.PROCESSING:
+                                    mark_failed(fi, 'error')
+                        lease.renew()
             
-            # Add vignette effect
-            img = add_vignette(img)
+            # Update job progress counters for the images still held, one
+            # atomic UPDATE per job
+            held = keep_leased(filtered_images, lease_owner)
+            tally = record_outcomes(held)
+            deferred_ids = [str(fi.id) for fi in deferred if fi in held]
+            
+            commit()
+            if deferred_ids:
+                print(f"Passing {len(deferred_ids)} filtered images of large originals to {LARGE_QUEUE}")
+                process_image_batch.apply_async(args=[deferred_ids, job_id, True], queue=LARGE_QUEUE)
+            return any(completed for completed, _ in tally.values())
         
-        # Save the modified image to a bytes buffer
-        buffer = io.BytesIO()
-        img.save(buffer, format='JPEG')
-        buffer.seek(0)
+        except Exception as e:
+            print(f"Error in process_image_batch task: {str(e)}")
+            try:
+                # Update any unfinished records to failed
+                if lease_owner:
+                    fail_unfinished(filtered_image_ids, lease_owner)
+            except:
+                pass
+            return False
         
-        return buffer.read()
+        finally:
+            # This chunk's slots are free; hand them to the next user in line
+            if scheduled:
+                schedule_bulk_work()
+
+@task_postrun.connect
+def flush_metrics(**kwargs):
+    """Push this worker process's metrics to Redis after tasks (at most every flush interval)"""
+    metrics.flush()
+
+def plan_batches(filtered_images):
+    """
+    Split a job's filtered images into chunks for process_image_batch
     
-    except Exception as e:
-        print(f"Error applying filter: {str(e)}")
-        return None
+    All filters over one original stay in the same chunk. Chunks close when
+    their originals' combined size reaches BATCH_MAX_BYTES or they hold
+    BATCH_MAX_IMAGES filtered images, so chunks of small images are large
+    and very large images travel almost alone. Originals not downloaded yet
+    count as BATCH_DEFAULT_IMAGE_BYTES. Originals known to be over
+    LARGE_IMAGE_PIXELS get a chunk each, for LARGE_QUEUE.
+    
+    Returns a list of (filtered image ids, large) pairs
+    """
+    groups = {}
+    for img in filtered_images:
+        groups.setdefault(img.image_id, []).append(str(img.id))
+    rows = db.session.query(Image.id, Image.file_size, Image.width, Image.height).filter(Image.id.in_(groups)).all()
+    sizes = {image_id: file_size for image_id, file_size, _, _ in rows}
+    large = {image_id for image_id, _, width, height in rows if is_large(width, height)}
+    
+    batches, current, current_bytes = [], [], 0
+    for image_id, ids in groups.items():
+        if image_id in large:
+            batches.append((ids, True))
+            continue
+        size = sizes.get(image_id) or BATCH_DEFAULT_IMAGE_BYTES
+        if current and (current_bytes + size > BATCH_MAX_BYTES or len(current) + len(ids) > BATCH_MAX_IMAGES):
+            batches.append((current, False))
+            current, current_bytes = [], 0
+        current.extend(ids)
+        current_bytes += size
+    if current:
+        batches.append((current, False))
+    return batches
+
+def lock_scheduler():
+    """Serialize schedulers with an advisory lock held until the transaction ends"""
+    db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': SCHEDULER_LOCK_KEY})
 
-def add_vignette(img, level=0.3):
-    """Add vignette effect to image"""
-    width, height = img.size
-    img = img.convert('RGB')
+def next_chunk(user_id, cutoff, limit=BATCH_MAX_IMAGES):
+    """
+    Return (job id, (filtered image ids, large)) for a user's next bulk chunk, oldest job first
     
-    # Create a radial gradient mask
-    mask = PILImage.new('L', (width, height), 255)
-    draw = PILImage.Draw(mask)
+    The chunk holds at most limit filtered images (and never more than BATCH_MAX_IMAGES).
+    """
+    rows = (
+        FilteredImage.query
+        .join(FilterJob, FilteredImage.filter_job_id == FilterJob.id)
+        .filter(FilterJob.user_id == user_id, *awaiting_dispatch(cutoff))
+        .order_by(FilterJob.created_at, FilteredImage.image_id)
+        .limit(min(limit, BATCH_MAX_IMAGES))
+        .all()
+    )
+    if not rows:
+        return None, ([], False)
+    job_id = rows[0].filter_job_id
+    rows = [fi for fi in rows if fi.filter_job_id == job_id]
+    return job_id, plan_batches(rows)[0]
+
+def awaiting_dispatch(cutoff):
+    """Criteria for pending images of started bulk jobs that are not queued"""
+    return (
+        FilteredImage.status == ProcessingStatus.PENDING,
+        or_(FilteredImage.dispatched_at.is_(None), FilteredImage.dispatched_at < cutoff),
+        FilterJob.status == ProcessingStatus.PROCESSING,
+        FilterJob.image_count > INTERACTIVE_MAX_IMAGES,
+    )
+
+def dispatch_bulk_work():
+    """
+    Queue bulk chunks until the in-flight limits are reached
     
-    radius = min(width, height) // 2
-    center_x, center_y = width // 2, height // 2
+    Each chunk goes to the user with the fewest images in flight, ties to
+    the user who has waited longest, so a new user's job starts as soon as
+    one chunk finishes however much another user has queued.
     
-    for y in range(height):
-        for x in range(width):
-            # Calculate distance from center
-            distance = ((x - center_x) ** 2 + (y - center_y) ** 2) ** 0.5
-            # Normalize distance to [0, 1]
-            norm_distance = min(1.0, distance / radius)
-            
-            # Darker at the edges
-            level_adjusted = max(0, 255 - int(255 * norm_distance * level))
-            mask.putpixel((x, y), level_adjusted)
+    Returns the number of chunks queued
+    """
+    lock_scheduler()
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=SCHEDULER_DISPATCH_TIMEOUT)
     
-    # Apply the mask
-    return PILImage.composite(img, PILImage.new('RGB', img.size, (0, 0, 0)), mask)
+    in_flight = dict(
+        db.session.query(FilterJob.user_id, func.count(FilteredImage.id))
+        .join(FilterJob, FilteredImage.filter_job_id == FilterJob.id)
+        .filter(FilteredImage.dispatched_at.isnot(None),
+                or_(FilteredImage.status == ProcessingStatus.PROCESSING,
+                    and_(FilteredImage.status == ProcessingStatus.PENDING,
+                         FilteredImage.dispatched_at >= cutoff)))
+        .group_by(FilterJob.user_id)
+        .all()
+    )
+    capacity = SCHEDULER_MAX_IN_FLIGHT - sum(in_flight.values())
+    if capacity <= 0:
+        db.session.rollback()
+        return 0
+    
+    waiting = (
+        db.session.query(FilterJob.user_id, func.min(FilterJob.created_at))
+        .join(FilteredImage, FilteredImage.filter_job_id == FilterJob.id)
+        .filter(*awaiting_dispatch(cutoff))
+        .group_by(FilterJob.user_id)
+        .all()
+    )
+    users = [(in_flight.get(user_id, 0), oldest, str(user_id), user_id) for user_id, oldest in waiting
+             if in_flight.get(user_id, 0) < SCHEDULER_USER_MAX_IN_FLIGHT]
+    heapq.heapify(users)
+    
+    chunks = []
+    while users and capacity > 0:
+        count, oldest, key, user_id = heapq.heappop(users)
+        # Never take more than this user's allowance or the free capacity
+        job_id, (ids, large) = next_chunk(user_id, cutoff,
+                                          min(capacity, SCHEDULER_USER_MAX_IN_FLIGHT - count))
+        if not ids:
+            continue
+        # Stamped now so the next query for this user skips them
+        db.session.execute(
+            update(FilteredImage)
+            .where(FilteredImage.id.in_([uuid.UUID(fid) for fid in ids]))
+            .values(dispatched_at=now)
+        )
+        chunks.append((job_id, ids, large))
+        capacity -= len(ids)
+        if count + len(ids) < SCHEDULER_USER_MAX_IN_FLIGHT:
+            heapq.heappush(users, (count + len(ids), oldest, key, user_id))
+    
+    # Committing releases the lock; a chunk that fails to queue is retried
+    # after SCHEDULER_DISPATCH_TIMEOUT
+    commit()
+    for job_id, ids, large in chunks:
+        process_image_batch.apply_async(args=[ids, str(job_id), large],
+                                        queue=LARGE_QUEUE if large else BULK_QUEUE)
+    return len(chunks)
 
-@celery_app.task(name='process_image')
-def process_image(filtered_image_id):
-    """Process a single image with the specified filter"""
+@celery_app.task(name='schedule_bulk_work')
+def schedule_bulk_work():
+    """Feed waiting bulk work to the bulk queue, fairly across users"""
     with app.app_context():
         try:
-            # Get filtered image record
-            filtered_image = FilteredImage.query.get(uuid.UUID(filtered_image_id))
-            if not filtered_image:
-                print(f"Filtered image {filtered_image_id} not found")
-                return False
-            
-            # Update status to processing
-            filtered_image.status = ProcessingStatus.PROCESSING
-            db.session.commit()
-            
-            # Get original image and filter
-            original_image = Image.query.get(filtered_image.image_id)
-            filter_obj = Filter.query.get(filtered_image.filter_id)
+            return dispatch_bulk_work()
+        except Exception as e:
+            print(f"Error in schedule_bulk_work task: {str(e)}")
+            db.session.rollback()
+            return 0
+
+@celery_app.task(name='reclaim_expired_leases')
+def reclaim_expired_leases():
+    """Return images whose worker died while processing them to the queue"""
+    with app.app_context():
+        try:
+            rows = db.session.execute(
+                update(FilteredImage)
+                .where(FilteredImage.status == ProcessingStatus.PROCESSING,
+                       FilteredImage.lease_expires_at < datetime.utcnow())
+                .values(status=ProcessingStatus.PENDING, lease_owner=None, lease_expires_at=None,
+                        dispatched_at=None)
+                .returning(FilteredImage.id, FilteredImage.filter_job_id)
+            ).all()
+            commit()
+            if not rows:
+                return 0
+            print(f"Reclaimed {len(rows)} filtered images with expired leases")
             
-            if not original_image or not filter_obj:
-                print(f"Original image or filter not found for {filtered_image_id}")
-                filtered_image.status = ProcessingStatus.FAILED
-                db.session.commit()
+            by_job = {}
+            for filtered_image_id, job_id in rows:
+                by_job.setdefault(job_id, []).append(str(filtered_image_id))
+            image_counts = dict(
+                db.session.query(FilterJob.id, FilterJob.image_count).filter(FilterJob.id.in_(by_job))
+            )
+            # Interactive images are queued again directly, bulk ones by the scheduler
+            for job_id, ids in by_job.items():
+                if queue_for_job(image_counts.get(job_id) or 0) == INTERACTIVE_QUEUE:
+                    process_image_batch.apply_async(args=[ids, str(job_id) if job_id else None],
+                                                    queue=INTERACTIVE_QUEUE)
+            schedule_bulk_work()
+            return len(rows)
+        
+        except Exception as e:
+            print(f"Error in reclaim_expired_leases task: {str(e)}")
+            db.session.rollback()
+            return 0
+
+@celery_app.task(name='generate_renditions')
+def generate_renditions(image_id, large=False):
+    """Create the preview renditions of a newly registered original"""
+    with app.app_context():
+        try:
+            image_uuid = uuid.UUID(image_id)
+            original_image = get_images([image_uuid]).get(image_uuid)
+            if not original_image:
+                print(f"Image {image_id} not found")
                 return False
             
-            # Download original image from storage
-            image_data = download_from_s3(original_image.original_url)
+            image_data = fetch_original(original_image)
             if not image_data:
                 print(f"Failed to download image from {original_image.original_url}")
-                filtered_image.status = ProcessingStatus.FAILED
-                db.session.commit()
                 return False
             
-            # Process the image with filter
-            processed_data = apply_filter(image_data, filter_obj.settings)
-            if not processed_data:
-                print(f"Failed to apply filter to image {filtered_image_id}")
-                filtered_image.status = ProcessingStatus.FAILED
-                db.session.commit()
+            # Check the header before decoding anything
+            info = inspect_original(original_image, image_data)
+            record_original(original_image, image_data)
+            verdict = admission(original_image, large)
+            if verdict != 'ok':
+                commit()
+                if verdict == 'too_large':
+                    print(f"Image {image_id} has more than {filters.MAX_IMAGE_PIXELS} pixels")
+                else:
+                    generate_renditions.apply_async(args=[image_id, True], queue=LARGE_QUEUE)
                 return False
             
-            # Upload processed image to storage
-            result_filename = f"filtered_{uuid.uuid4()}.jpg"
-            result_url = upload_to_s3(processed_data, result_filename)
+            # Decode only as large as the biggest rendition needs
+            with decode_budget.reserve(filters.decoded_size(info)):
+                img = filters.decode_image(image_data, max(filters.RENDITION_SIZES))
+                del image_data
+                img, _ = filters.split_alpha(img, keep=False)
+                # Palette, 16-bit and other modes cannot all be saved as JPEG
+                if img.mode != 'RGB':
+                    img = img.convert('RGB')
+                # img may be decoded down to the largest rendition; skip
+                # sizes by the original's own dimensions
+                renditions = filters.make_renditions(img, source_size=max(info.width, info.height))
             
-            if not result_url:
-                print(f"Failed to upload processed image {filtered_image_id}")
-                filtered_image.status = ProcessingStatus.FAILED
-                db.session.commit()
-                return False
-            
-            # Update filtered image record
-            filtered_image.result_url = result_url
-            filtered_image.status = ProcessingStatus.COMPLETED
-            
-            # Update job completion count
-            if filtered_image.filter_job_id:
-                job = FilterJob.query.get(filtered_image.filter_job_id)
-                if job:
-                    job.completed_count += 1
-                    if job.completed_count >= job.image_count:
-                        job.status = ProcessingStatus.COMPLETED
-            
-            db.session.commit()
-            return True
+            rendition_urls = upload_renditions(renditions, f"rendition_{original_image.id}")
+            db.session.execute(update(Image).where(Image.id == image_uuid).values(renditions=rendition_urls))
+            commit()
+            return rendition_urls is not None
         
         except Exception as e:
-            print(f"Error in process_image task: {str(e)}")
-            try:
-                # Update status to failed
-                filtered_image = FilteredImage.query.get(uuid.UUID(filtered_image_id))
-                if filtered_image:
-                    filtered_image.status = ProcessingStatus.FAILED
-                    db.session.commit()
-            except:
-                pass
+            print(f"Error in generate_renditions task: {str(e)}")
             return False
 
 @celery_app.task(name='process_job')
@@ -265,16 +1447,32 @@ def process_job(job_id):
                 print(f"Job {job_id} not found")
                 return False
             
-            # Update job status
-            job.status = ProcessingStatus.PROCESSING
-            db.session.commit()
+            # Start the job only once: a re-triggered process_job must not
+            # reopen a job that was cancelled, has finished or is already running
+            started = db.session.execute(
+                update(FilterJob)
+                .where(FilterJob.id == job.id, FilterJob.status == ProcessingStatus.PENDING)
+                .values(status=ProcessingStatus.PROCESSING)
+            ).rowcount
+            commit()
+            if not started:
+                print(f"Job {job_id} is already {job.status.value}")
+                return False
+            
+            # Bulk jobs share the bulk queue fairly through the scheduler
+            if queue_for_job(job.image_count) == BULK_QUEUE:
+                schedule_bulk_work()
+                return True
             
             # Get all filtered images for this job
-            filtered_images = FilteredImage.query.filter_by(filter_job_id=job.id).all()
+            filtered_images = FilteredImage.query.filter(
+                FilteredImage.filter_job_id == job.id, FilteredImage.status != ProcessingStatus.CANCELLED
+            ).all()
             
-            # Queue each image for processing
-            for img in filtered_images:
-                process_image.delay(str(img.id))
+            # Queue chunks sized by the bytes of their originals
+            for ids, large in plan_batches(filtered_images):
+                process_image_batch.apply_async(args=[ids, job_id, large],
+                                                queue=LARGE_QUEUE if large else INTERACTIVE_QUEUE)
             
             return True
         
@@ -285,7 +1483,7 @@ def process_job(job_id):
                 job = FilterJob.query.get(uuid.UUID(job_id))
                 if job:
                     job.status = ProcessingStatus.FAILED
-                    db.session.commit()
+                    commit()
             except:
                 pass
             return False
@@ -0,0 +1,4 @@
+import os
+
+# Tests exercise the modules alone, without pushing metrics to Redis
+os.environ.setdefault('METRICS_ENABLED', 'false')
@@ -0,0 +1,38 @@
+"""
+Checks of the keys that identify reusable rendered results
+"""
+import filters
+
+CONTENT_HASH = 'a' * 64
+SETTINGS = {'steps': [{'type': 'contrast', 'factor': 1.2}, {'type': 'vignette', 'level': 0.5}]}
+
+
+def test_key_is_stable_across_dict_ordering():
+    reordered = {'steps': [{'factor': 1.2, 'type': 'contrast'}, {'level': 0.5, 'type': 'vignette'}]}
+    output = {'format': 'webp', 'quality': 80}
+    assert (filters.result_cache_key(CONTENT_HASH, SETTINGS, 1080, output)
+            == filters.result_cache_key(CONTENT_HASH, reordered, 1080, {'quality': 80, 'format': 'webp'}))
+
+
+def test_key_treats_missing_options_as_empty():
+    assert filters.result_cache_key(CONTENT_HASH, SETTINGS) == filters.result_cache_key(
+        CONTENT_HASH, SETTINGS, None, {})
+
+
+def test_key_changes_with_every_input():
+    base = filters.result_cache_key(CONTENT_HASH, SETTINGS, 1080, {'format': 'jpeg'})
+    variants = [
+        filters.result_cache_key('b' * 64, SETTINGS, 1080, {'format': 'jpeg'}),
+        filters.result_cache_key(CONTENT_HASH, {'steps': SETTINGS['steps'][::-1]}, 1080, {'format': 'jpeg'}),
+        filters.result_cache_key(CONTENT_HASH, SETTINGS, 512, {'format': 'jpeg'}),
+        filters.result_cache_key(CONTENT_HASH, SETTINGS, None, {'format': 'jpeg'}),
+        filters.result_cache_key(CONTENT_HASH, SETTINGS, 1080, {'format': 'png'}),
+        filters.result_cache_key(CONTENT_HASH, SETTINGS, 1080, {'format': 'jpeg', 'quality': 90}),
+    ]
+    assert len({base, *variants}) == len(variants) + 1
+
+
+def test_key_changes_with_engine_version(monkeypatch):
+    before = filters.result_cache_key(CONTENT_HASH, SETTINGS)
+    monkeypatch.setattr(filters, 'ENGINE_VERSION', filters.ENGINE_VERSION + 1)
+    assert filters.result_cache_key(CONTENT_HASH, SETTINGS) != before
@@ -0,0 +1,97 @@
+"""
+Checks of output option validation and encoding
+"""
+import io
+
+import pytest
+from PIL import Image as PILImage
+
+import encoders
+
+
+def transparent_image():
+    """Red RGBA image whose left half is fully transparent"""
+    img = PILImage.new('RGBA', (40, 20), (255, 0, 0, 255))
+    img.paste((255, 0, 0, 0), (0, 0, 20, 20))
+    return img
+
+
+def decoded(encoded):
+    return PILImage.open(io.BytesIO(encoded.data))
+
+
+@pytest.mark.parametrize('options, parsed', [
+    (None, {}),
+    ({}, {}),
+    ({'format': 'JPG', 'quality': 80}, {'format': 'jpeg', 'quality': 80}),
+    ({'format': 'webp', 'lossless': True}, {'format': 'webp', 'lossless': True}),
+    ({'format': 'jpeg', 'progressive': True, 'subsampling': '4:4:4'},
+     {'format': 'jpeg', 'progressive': True, 'subsampling': '4:4:4'}),
+])
+def test_parse_output_options(options, parsed):
+    assert encoders.parse_output_options(options) == parsed
+
+
+@pytest.mark.parametrize('options', [
+    'png',
+    {'format': 'bmp'},
+    {'colour': 'red'},
+    {'quality': 0},
+    {'quality': 101},
+    {'quality': '90'},
+    {'quality': True},
+    {'progressive': 'yes'},
+    {'subsampling': '4:1:1'},
+])
+def test_parse_output_options_rejects_invalid_options(options):
+    with pytest.raises(ValueError):
+        encoders.parse_output_options(options)
+
+
+def test_resolve_output_options_prefers_the_job():
+    filter_settings = {'type': 'sepia', 'output': {'format': 'png', 'optimize': True}}
+    assert encoders.resolve_output_options(filter_settings, {'output': {'format': 'webp'}}) == {
+        'format': 'webp', 'optimize': True}
+    assert encoders.resolve_output_options([{'type': 'sepia'}]) == {}
+
+
+@pytest.mark.parametrize('fmt, content_type, extension, pil_format', [
+    (None, 'image/jpeg', 'jpg', 'JPEG'),
+    ('jpeg', 'image/jpeg', 'jpg', 'JPEG'),
+    ('png', 'image/png', 'png', 'PNG'),
+    ('webp', 'image/webp', 'webp', 'WEBP'),
+])
+def test_encode_reports_content_type_and_extension(fmt, content_type, extension, pil_format):
+    options = {'format': fmt} if fmt else {}
+    encoded = encoders.encode(PILImage.new('RGB', (16, 16), (0, 128, 255)), options)
+    assert (encoded.content_type, encoded.extension) == (content_type, extension)
+    assert decoded(encoded).format == pil_format
+
+
+@pytest.mark.parametrize('options', [{'format': 'png'}, {'format': 'webp', 'lossless': True}])
+def test_encode_keeps_alpha_where_supported(options):
+    img = decoded(encoders.encode(transparent_image(), options))
+    assert img.mode == 'RGBA'
+    assert img.getpixel((5, 5))[3] == 0
+    assert img.getpixel((35, 5)) == (255, 0, 0, 255)
+
+
+def test_encode_flattens_alpha_onto_white_for_jpeg():
+    img = decoded(encoders.encode(transparent_image(), {'format': 'jpeg', 'quality': 95}))
+    assert img.mode == 'RGB'
+    assert all(channel > 245 for channel in img.getpixel((5, 5)))
+    red, green, blue = img.getpixel((35, 5))
+    assert red > 245 and green < 10 and blue < 10
+
+
+def test_encode_applies_quality():
+    img = PILImage.effect_noise((64, 64), 64).convert('RGB')
+    low = encoders.encode(img, {'quality': 10})
+    high = encoders.encode(img, {'quality': 95})
+    assert len(low.data) < len(high.data)
+
+
+def test_supports_alpha():
+    assert not encoders.supports_alpha({})
+    assert not encoders.supports_alpha({'format': 'jpeg'})
+    assert encoders.supports_alpha({'format': 'png'})
@@ -0,0 +1,184 @@
+"""
+Checks of the filter engine against the original per-pixel filters
+
+The reference functions below are the Python loops the engine replaced,
+kept only to pin down how far the fast paths may drift from them.
+"""
+import io
+
+import pytest
+from PIL import Image as PILImage
+from PIL import ImageChops, ImageEnhance
+
+import filters
+
+SIZES = [(160, 120), (257, 131), (300, 200)]
+
+
+def synthetic_image(size):
+    """Deterministic RGB image with gradients and fine detail"""
+    gradient = PILImage.linear_gradient('L').resize(size)
+    noise = PILImage.effect_noise(size, 64)
+    return PILImage.merge('RGB', (gradient, noise, gradient.rotate(180)))
+
+
+def max_difference(a, b):
+    """Largest difference between two images in any channel"""
+    extrema = ImageChops.difference(a, b).getextrema()
+    if a.mode == 'L':
+        extrema = [extrema]
+    return max(high for _, high in extrema)
+
+
+def reference_sepia(img):
+    img = img.convert('RGB')
+    pixels = img.load()
+    for x in range(img.width):
+        for y in range(img.height):
+            r, g, b = pixels[x, y]
+            pixels[x, y] = (
+                int(min(255, r * 0.393 + g * 0.769 + b * 0.189)),
+                int(min(255, r * 0.349 + g * 0.686 + b * 0.168)),
+                int(min(255, r * 0.272 + g * 0.534 + b * 0.131)),
+            )
+    return img
+
+
+def reference_vignette_mask(width, height, level=0.3):
+    """Darkening mask by the exact formula (255 means fully darkened)"""
+    mask = PILImage.new('L', (width, height))
+    radius = min(width, height) // 2
+    center_x, center_y = width // 2, height // 2
+    for y in range(height):
+        for x in range(width):
+            distance = ((x - center_x) ** 2 + (y - center_y) ** 2) ** 0.5
+            mask.putpixel((x, y), int(255 * min(1.0, distance / radius) * level))
+    return mask
+
+
+def reference_vignette(img, level=0.3):
+    img = img.convert('RGB')
+    keep = reference_vignette_mask(img.width, img.height, level).point(lambda value: 255 - value)
+    return PILImage.composite(img, PILImage.new('RGB', img.size, (0, 0, 0)), keep)
+
+
+def reference_vintage(img):
+    img = ImageEnhance.Color(img).enhance(0.8).convert('RGB')
+    pixels = img.load()
+    for x in range(img.width):
+        for y in range(img.height):
+            r, g, b = pixels[x, y]
+            pixels[x, y] = (min(255, int(r * 0.9)), min(255, int(g * 0.9)), min(255, int(b * 0.7)))
+    return reference_vignette(img)
+
+
+def run_unfused(steps, img):
+    """Apply each step on its own, in order, without fusing any of them"""
+    img = img.convert('RGB')
+    for step in steps:
+        for expanded in filters.STEP_TYPES[step['type']](step):
+            img = expanded.apply(img)
+    return img
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_sepia_matches_reference(size):
+    img = synthetic_image(size)
+    result = filters.run_plan(filters.compile_settings({'type': 'sepia'}), img.copy())
+    assert max_difference(result, reference_sepia(img.copy())) <= 1
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_vintage_matches_reference(size):
+    img = synthetic_image(size)
+    result = filters.run_plan(filters.compile_settings({'type': 'vintage'}), img.copy())
+    assert max_difference(result, reference_vintage(img)) <= 2
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_vignette_matches_reference(size):
+    img = synthetic_image(size)
+    assert max_difference(filters.add_vignette(img), reference_vignette(img)) <= 1
+
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('level, tolerance', [(0.3, 1), (1.0, 4)])
+def test_vignette_mask_matches_formula(size, level, tolerance):
+    mask = filters.vignette_mask(size[0], size[1], level)
+    assert max_difference(mask, reference_vignette_mask(size[0], size[1], level)) <= tolerance
+
+
+def test_add_vignette_leaves_input_unchanged():
+    img = synthetic_image((160, 120))
+    before = img.copy()
+    filters.add_vignette(img)
+    assert max_difference(img, before) == 0
+
+
+@pytest.mark.parametrize('steps, fused_names, tolerance', [
+    # Chained per-channel tables compose exactly
+    ([{'type': 'brightness', 'value': 1.1}, {'type': 'tone'}], ['brightness+tone'], 0),
+    ([{'type': 'tone'}, {'type': 'brightness', 'value': 1.3}, {'type': 'contrast'}],
+     ['tone+brightness', 'contrast'], 0),
+    # Multiplied matrices skip the truncation between the two steps
+    ([{'type': 'desaturate'}, {'type': 'tone'}], ['desaturate+tone'], 2),
+    ([{'type': 'grayscale'}, {'type': 'sepia'}], ['grayscale+sepia'], 2),
+    ([{'type': 'desaturate', 'value': 0.5}, {'type': 'sepia'}], ['desaturate+sepia'], 2),
+    # Sepia can exceed 255, so what follows it is not fused
+    ([{'type': 'sepia'}, {'type': 'brightness', 'value': 0.9}], ['sepia', 'brightness'], 0),
+    ([{'type': 'vintage'}], ['desaturate+tone', 'vignette'], 2),
+])
+def test_fused_plan_matches_unfused_steps(steps, fused_names, tolerance):
+    img = synthetic_image((300, 200))
+    plan = filters.compile_steps(steps)
+    assert [step.name for step in plan] == fused_names
+    assert max_difference(filters.run_plan(plan, img.copy()), run_unfused(steps, img.copy())) <= tolerance
+
+
+@pytest.mark.parametrize('steps, tolerance', [
+    ([{'type': 'blur', 'radius': 3}, {'type': 'sharpen'}], 0),
+    ([{'type': 'sepia'}, {'type': 'contrast'}], 0),
+    # Each strip's vignette mask is resampled on its own
+    ([{'type': 'vintage'}], 1),
+    ([{'type': 'contrast'}, {'type': 'blur'}, {'type': 'vignette', 'level': 1.0}], 2),
+])
+def test_tiled_plan_matches_whole_image(steps, tolerance):
+    img = synthetic_image((600, 800))
+    plan = filters.compile_steps(steps)
+    whole = filters.run_plan(plan, img.copy())
+    assert max_difference(filters.run_plan_tiled(plan, img.copy(), strip_height=64), whole) <= tolerance
+
+
+def test_region_masks_are_not_cached():
+    whole = filters.vignette_mask(600, 800)
+    for top in range(0, 800, 64):
+        filters.vignette_mask(600, 800, 0.3, (0, top, 600, min(800, top + 64)))
+    assert filters.vignette_mask(600, 800) is whole
+
+
+def test_renditions_of_reduced_decode_include_every_size():
+    buffer = io.BytesIO()
+    synthetic_image((4000, 3000)).save(buffer, 'JPEG')
+    data = buffer.getvalue()
+    info = filters.inspect_image(data)
+    img = filters.decode_image(data, max(filters.RENDITION_SIZES))
+    renditions = filters.make_renditions(img, (128, 512, 1080), source_size=max(info.width, info.height))
+    assert sorted(renditions, key=int) == ['128', '512', '1080']
+
+
+def test_renditions_skip_sizes_at_or_above_the_source():
+    renditions = filters.make_renditions(synthetic_image((512, 384)), (128, 512, 1080))
+    assert list(renditions) == ['128']
+
+
+def test_render_original_matches_separate_renders():
+    buffer = io.BytesIO()
+    synthetic_image((300, 200)).save(buffer, 'PNG')
+    png = {'format': 'png'}
+    # Vignette filters in place, so later specs only match if it had a copy
+    specs = [({'type': 'vignette'}, None, png), ({'type': 'sepia'}, 150, png), ({'type': 'vintage'}, None, png)]
+    results = filters.render_original(buffer.getvalue(), specs)
+    for (settings, max_dimension, output_options), result in zip(specs, results):
+        img = filters.fit_image(filters.decode_image(buffer.getvalue()), max_dimension)
+        expected = filters.render(img, settings, output_options)
+        assert result.data == expected.data
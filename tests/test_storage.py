@@ -0,0 +1,147 @@
+"""
+Checks of the storage module against the local disk backend
+
+Everything here runs on a temporary directory, without S3 or a network.
+"""
+import io
+import os
+
+import pytest
+
+import storage
+
+BASE_URL = 'http://files.test/media'
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    """Store files under a temporary directory for the duration of a test"""
+    backend = storage.LocalBackend(str(tmp_path / 'files'), BASE_URL + '/')
+    monkeypatch.setattr(storage, '_backend', backend)
+    monkeypatch.setattr(storage, 'STORAGE_CACHE_DIR', None)
+    monkeypatch.setattr(storage, '_disk_cache_pid', None)
+    return backend
+
+
+@pytest.fixture
+def disk_cache(tmp_path, monkeypatch, backend):
+    """Turn on the read-through disk cache in a temporary directory"""
+    monkeypatch.setattr(storage, 'STORAGE_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(storage, 'STORAGE_CACHE_MB', 1)
+    return storage.get_disk_cache()
+
+
+def test_object_key_spreads_names_over_hash_prefixes():
+    key = storage.object_key('photo.jpg')
+    prefix, sub, name = key.split('/')
+    assert name == 'photo.jpg'
+    assert len(prefix) == len(sub) == 2
+    assert storage.object_key('photo.jpg') == key
+    assert storage.object_key('other.jpg') != key
+
+
+def test_upload_and_download_round_trip(backend):
+    stored = storage.upload_file(b'image bytes', 'photo.jpg')
+    assert stored.key == storage.object_key('photo.jpg')
+    assert stored.bucket is None
+    assert stored.url == f"{BASE_URL}/{stored.key}"
+    assert storage.download_file(stored.url) == b'image bytes'
+    assert storage.head_file(stored.key) == {'size': 11, 'content_type': 'image/jpeg'}
+
+
+def test_upload_streams_file_objects(backend):
+    stored = storage.upload_file(io.BytesIO(b'x' * 300000), 'big.png', 'image/png')
+    with storage.open_file(stored.url) as f:
+        assert f.read() == b'x' * 300000
+
+
+def test_upload_secures_file_names(backend):
+    stored = storage.upload_file(b'data', '../../etc/passwd')
+    assert stored.key.endswith('/etc_passwd')
+    assert os.path.exists(os.path.join(backend.root, stored.key))
+
+
+def test_delete_file(backend):
+    stored = storage.upload_file(b'data', 'photo.jpg')
+    assert storage.delete_file(stored.key)
+    assert storage.download_file(stored.url) is None
+    assert not storage.delete_file(stored.key)
+
+
+@pytest.mark.parametrize('url, key', [
+    (BASE_URL + '/ab/cd/photo.jpg', 'ab/cd/photo.jpg'),
+    (BASE_URL + '/', None),
+    ('http://files.test/other/ab/cd/photo.jpg', None),
+    ('http://elsewhere.test/media/ab/cd/photo.jpg', None),
+])
+def test_key_for_url_only_accepts_local_urls(backend, url, key):
+    assert storage.key_for_url(url) == key
+
+
+@pytest.mark.parametrize('url, key', [
+    ('https://s3.test/bucket/ab/cd/photo.jpg', 'ab/cd/photo.jpg'),
+    ('https://s3.test/bucket/', None),
+    ('https://s3.test/other-bucket/ab/cd/photo.jpg', None),
+    ('https://s3.test/bucketx/photo.jpg', None),
+    ('https://attacker.test/bucket/photo.jpg', None),
+])
+def test_key_for_url_only_accepts_the_configured_bucket(url, key):
+    assert storage.S3Backend('bucket', 'https://s3.test').key_for_url(url) == key
+
+
+def test_foreign_urls_are_never_read(backend):
+    assert storage.download_file('http://elsewhere.test/media/photo.jpg') is None
+    assert storage.open_file('http://elsewhere.test/media/photo.jpg') is None
+
+
+def test_keys_cannot_escape_the_root(backend):
+    assert storage.head_file('../outside.jpg') is None
+    assert storage.download_file(f"{BASE_URL}/../outside.jpg") is None
+
+
+def test_disk_cache_hit_and_miss(backend, disk_cache):
+    stored = storage.upload_file(b'cached bytes', 'photo.jpg')
+    assert os.listdir(disk_cache.directory) == []
+
+    with storage.open_file(stored.url) as f:
+        assert f.read() == b'cached bytes'
+    assert len(os.listdir(disk_cache.directory)) == 1
+
+    # Later reads come from the cache, even once the original is gone
+    os.remove(os.path.join(backend.root, stored.key))
+    with storage.open_file(stored.url) as f:
+        assert f.read() == b'cached bytes'
+
+
+def test_disk_cache_does_not_keep_oversized_files(tmp_path):
+    cache = storage.DiskCache(str(tmp_path), 1000)
+    with cache.fill('big', lambda f: f.write(b'x' * 300)) as f:
+        assert f.read() == b'x' * 300
+    assert cache.open('big') is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = storage.DiskCache(str(tmp_path), 1000)
+    for name in ('a', 'b', 'c', 'd'):
+        cache.fill(name, lambda f: f.write(b'x' * 240)).close()
+        # Spread modification times so the order is unambiguous
+        os.utime(cache._path(name), (len(os.listdir(tmp_path)),) * 2)
+    cache.open('a').close()
+
+    cache.fill('e', lambda f: f.write(b'x' * 240)).close()
+
+    kept = {name for name in 'abcde' if os.path.exists(cache._path(name))}
+    assert kept == {'a', 'd', 'e'}
+
+
+def test_disk_cache_discards_failed_downloads(tmp_path):
+    cache = storage.DiskCache(str(tmp_path), 1000)
+
+    def download(f):
+        f.write(b'partial')
+        raise IOError("connection reset")
+
+    with pytest.raises(IOError):
+        cache.fill('broken', download)
+    assert os.listdir(tmp_path) == []